@@ -0,0 +1,345 @@
+# Benchmarks startup (import time) and read, prepare, render and send stages on synthetic workbooks.
+# Usage: python benchmark.py --rows 1000 10000 100000 --output bench.json
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SHEET_NAME = 'Data'
+COLUMNS = ['Nome', 'E-mail', 'Nota', 'Data', 'Comentario']
+# heavy modules that must not be loaded just by starting main.py (Google, xlsx, SMTP and serve stacks)
+LAZY_MODULES = ['googleapiclient', 'google_auth_oauthlib', 'httplib2', 'openpyxl', 'smtplib', 'ssl', 'http.server']
+
+
+def make_workbook(path, rows):
+    """
+    Synthetic workbook with a formatted header, styled cells and a second sheet.
+    """
+    from openpyxl import Workbook
+    from openpyxl.styles import Alignment, Font, PatternFill
+
+    wb = Workbook(write_only=False)
+    ws = wb.active
+    ws.title = SHEET_NAME
+    ws.append(COLUMNS)
+    for c in ws[1]:
+        c.font = Font(bold=True)
+        c.fill = PatternFill('solid', fgColor='DDDDDD')
+        c.alignment = Alignment(horizontal='center')
+    ws.column_dimensions['A'].width = 30
+    ws.column_dimensions['B'].width = 30
+    ws.column_dimensions['E'].width = 60
+
+    red = Font(color='FF0000')
+    start = datetime(2020, 1, 1)
+    for i in range(rows):
+        ws.append(['Aluno {}'.format(i), 'aluno{}@example.com'.format(i), i % 10, start + timedelta(days=i % 365),
+                   'Comentario sobre a entrega {}'.format(i)])
+        if i % 10 < 5:
+            ws.cell(row=i + 2, column=3).font = red
+    wb.create_sheet('Other').append(['not', 'used'])
+    wb.save(path)
+
+
+class SinkHandler(socketserver.BaseRequestHandler):
+    """
+    Minimal SMTP server that accepts and discards every message. Replies are only sent when every
+    command received so far was read (the client is waiting), after the server latency: one
+    simulated round trip per exchange, so pipelined commands share a round trip.
+    """
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        self.pos = 0
+        self.replies = ['220 sink']
+        in_data = False
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    with self.server.messages.get_lock():
+                        self.server.messages.value += 1
+                    self.replies.append('250 OK')
+                continue
+
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.replies += ['250-sink', '250 PIPELINING']
+            elif command == b'HELO':
+                self.replies.append('250 sink')
+            elif command == b'DATA':
+                self.replies.append('354 go ahead')
+                in_data = True
+            elif command == b'QUIT':
+                self.replies.append('221 bye')
+                self.flush()
+                return
+            else:
+                self.replies.append('250 OK')
+
+    def flush(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.request.sendall(''.join(r + '\r\n' for r in self.replies).encode('ascii'))
+        self.replies = []
+
+    def readline(self):
+        end = self.buffer.find(b'\n', self.pos)
+        while end < 0:
+            if self.replies:
+                self.flush()
+            data = self.request.recv(64 * 1024)
+            if not data:
+                return None
+            self.buffer = self.buffer[self.pos:] + data
+            self.pos = 0
+            end = self.buffer.find(b'\n')
+        line = self.buffer[self.pos:end + 1]
+        self.pos = end + 1
+        return line
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    messages = None  # multiprocessing.Value shared with the benchmark process
+    latency = 0
+
+
+def _serve_sink(conn, messages, latency):
+    server = SinkServer(('127.0.0.1', 0), SinkHandler)
+    server.messages = messages
+    server.latency = latency
+    conn.send(server.server_address)
+    server.serve_forever()
+
+
+def start_sink(latency=0):
+    """
+    Runs the sink in its own process, so it does not compete with the sender for the GIL.
+    :param latency: seconds added to every round trip
+    :return: process, (host, port) and shared count of received messages
+    """
+    ctx = multiprocessing.get_context('spawn')
+    messages = ctx.Value('i', 0)
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=_serve_sink, args=(child, messages, latency), daemon=True)
+    process.start()
+    return process, parent.recv(), messages
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def at(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+    return {'p50': at(0.50), 'p90': at(0.90), 'p99': at(0.99), 'max': latencies[-1]}
+
+
+def make_config(rows):
+    return {'workers': 1,
+            'sheet': {'url': 'bench.xlsx', 'name': SHEET_NAME, 'header-rows': 1, 'start-row': 1,
+                      'email-col': 2, 'range': 'A1:E{}'.format(rows + 1)},
+            'email': {'subject': 'Feedback {Nome}', 'cc': '',
+                      'msg': 'Hello **{Nome}**,\n\nyour grade is {Nota}.\n\natt,\n\nBench'}}
+
+
+def bench_stage(stage, workbook, rows, limit, connections, latency=0):
+    """
+    Runs one stage (in its own process, so peak RSS is only this stage's).
+    :return: dict with count, seconds, throughput, latency percentiles and peak RSS (KiB)
+    """
+    import excel
+    from mail_async import AsyncEmailBackend
+    from mail_send import EmailBackend, PooledEmailBackend
+    from mail_util import iter_mails
+    from metrics import metrics
+
+    config = make_config(rows)
+    credentials = {'username': 'bench@example.com'}
+    headers = {i: name for i, name in enumerate(COLUMNS)}
+    latencies = []
+
+    def mails(count):
+        data = excel.read_table(workbook, SHEET_NAME, config['sheet']['range'])[1:count + 1]
+        return iter_mails(data, config, credentials, workbook, headers=headers)
+
+    start = time.perf_counter()
+    if stage == 'read':
+        count = 0
+        last = time.perf_counter()
+        for _ in excel.iter_sheet(workbook, SHEET_NAME, config['sheet']['range']):
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+            count += 1
+    elif stage == 'read-table':
+        # whole sheet kept in memory, as main.py does (compare peak RSS with 'read')
+        count = len(excel.read_table(workbook, SHEET_NAME, config['sheet']['range']))
+    elif stage == 'prepare':
+        prepared = mails(limit)
+        start = time.perf_counter()
+        count = 0
+        last = time.perf_counter()
+        for _ in prepared:
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+            count += 1
+    elif stage == 'render':
+        prepared = list(mails(limit))
+        start = time.perf_counter()
+        for m in prepared:
+            t = time.perf_counter()
+            b''.join(m.message_chunks())
+            latencies.append(time.perf_counter() - t)
+        count = len(prepared)
+    elif stage in ('send', 'send-pooled', 'send-async'):
+        sink, (host, port), received = start_sink(latency)
+        prepared = list(mails(limit))
+        # latency of every message (MAIL FROM to the reply to its data) from the sendmail events of the metrics log
+        log_path = '{}.{}.jsonl'.format(workbook, stage)
+        metrics.open_log(log_path)
+        start = time.perf_counter()
+        if stage == 'send':
+            backend = EmailBackend(host, port, None, None)
+            backend.open_connection()
+            for m in prepared:
+                backend._send(m)
+            backend.close_connection()
+        elif stage == 'send-pooled':
+            PooledEmailBackend(host, port, None, None, connections=connections).send_messages(prepared)
+        else:
+            AsyncEmailBackend(host, port, None, None, connections=connections).send_messages(prepared)
+        metrics.close()
+        with open(log_path) as f:
+            latencies = [event['seconds'] for event in map(json.loads, f) if event.get('stage') == 'sendmail']
+        os.unlink(log_path)
+        count = received.value
+        sink.terminate()
+    else:
+        raise ValueError('Unknown stage {}'.format(stage))
+    seconds = time.perf_counter() - start
+
+    return {'stage': stage, 'rows': rows, 'count': count, 'seconds': seconds, 'smtp_round_trip': latency,
+            'throughput': count / seconds if seconds > 0 else None,
+            'latency': percentiles(latencies),
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def bench_startup(here):
+    """
+    Imports main in a fresh interpreter with -X importtime.
+    :return: dict with import and wall time, slowest imports and heavy modules loaded at startup
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=here,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True).stderr.decode()
+    seconds = time.perf_counter() - start
+
+    imported = {}
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        if name == 'site':
+            # everything before (and including) site is interpreter startup
+            imported = {}
+            continue
+        imported[name] = int(fields[1]) / 1e6
+
+    slowest = sorted((n for n in imported if n != 'main'), key=imported.get, reverse=True)[:10]
+    return {'stage': 'startup', 'import_seconds': imported.get('main'), 'wall_seconds': seconds,
+            'slowest': {n: imported[n] for n in slowest},
+            'eager': [m for m in LAZY_MODULES if m in imported]}
+
+
+def _run_in_child(conn, *args):
+    # silence 'Sending mail to' prints
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        conn.send(bench_stage(*args))
+    except Exception as e:
+        conn.send({'stage': args[0], 'rows': args[2], 'error': repr(e)})
+
+
+def run_isolated(*args):
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    p = ctx.Process(target=_run_in_child, args=(child,) + args)
+    p.start()
+    result = parent.recv()
+    p.join()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    stages = ['startup', 'read', 'read-table', 'prepare', 'render', 'send', 'send-pooled', 'send-async']
+    parser = argparse.ArgumentParser(description='Benchmarks mailsheet stages')
+    parser.add_argument('--rows', default=[1000, 10000], type=int, nargs='+', help='Workbook sizes. Default: 1000 10000')
+    parser.add_argument('--stages', default=stages, nargs='+', choices=stages, help='Stages to run. Default: all')
+    parser.add_argument('--limit', default=500, type=int, help='Max rows used by prepare, render and send stages. Default: 500')
+    parser.add_argument('--connections', default=4, type=int, help='Connections used by send-pooled and send-async. Default: 4')
+    parser.add_argument('--latency', default=0, type=float, help='Simulated SMTP round trip in ms, for send stages. Default: 0')
+    parser.add_argument('--output', default='benchmark.json', type=str, help='JSON results file. Default: benchmark.json')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    report = {'commit': git_commit(), 'python': sys.version, 'date': datetime.now().isoformat(), 'results': []}
+    workdir = tempfile.mkdtemp(prefix='mailsheet-bench-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+
+    failed = False
+    if 'startup' in args.stages:
+        result = bench_startup(here)
+        report['results'].append(result)
+        print('{:>12} import main {:.1f}ms, wall {:.1f}ms'.format('startup', result['import_seconds'] * 1000,
+                                                                  result['wall_seconds'] * 1000))
+        if result['eager']:
+            print('{:>12} loaded at startup: {}'.format('ERROR', ', '.join(result['eager'])))
+            failed = True
+
+    row_stages = [s for s in args.stages if s != 'startup']
+    for rows in args.rows if row_stages else []:
+        workbook = os.path.join(workdir, 'bench-{}.xlsx'.format(rows))
+        print('Generating workbook with {} rows...'.format(rows))
+        make_workbook(workbook, rows)
+        for stage in row_stages:
+            result = run_isolated(stage, workbook, rows, min(rows, args.limit), args.connections, args.latency / 1000)
+            report['results'].append(result)
+            if 'error' in result:
+                print('{:>12} {:>7} rows: {}'.format(stage, rows, result['error']))
+            else:
+                print('{:>12} {:>7} rows: {:>7} items {:>10.1f}/s  p50 {:.2f}ms  peak RSS {} KiB'.format(
+                    stage, rows, result['count'], result['throughput'] or 0,
+                    result['latency'].get('p50', 0) * 1000, result['peak_rss_kib']))
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to {}'.format(output))
+    if failed:
+        sys.exit(1)
@@ -1,9 +1,19 @@
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from datetime import datetime, timezone
+from io import BytesIO
+from itertools import islice
+import multiprocessing
+from xml.etree import ElementTree
+import zipfile
 
 from openpyxl import load_workbook
 from openpyxl.utils import column_index_from_string
 import re
 
+from sheet_table import DATE_FORMAT, SheetTable
+
 
 class InvalidSheetRangeException(Exception):
     pass
@@ -30,27 +40,59 @@ def get_ranges(sheet_range):
     raise InvalidSheetRangeException('Provided range is invalid')
 
 
-def read_sheet(file_path, sheet_name, sheet_range):
-    wb = load_workbook(filename=file_path)
-    ws = wb[sheet_name]
+def _date_text(val):
+    return val.strftime(DATE_FORMAT)
+
+
+def _empty_text(val):
+    return ''
+
+
+# cell value type => conversion to the value returned by read_sheet (other types are kept)
+converters = {datetime: _date_text, type(None): _empty_text}
+
+
+def iter_sheet(file_path, sheet_name, sheet_range, raw=False):
+    """
+    Yields sheet values row by row, reading the workbook in read-only (streaming) mode.
+    Open-ended ranges (example A:E) stop at the last row in the file.
+    :param file_path: xlsx file
+    :param sheet_name: sheet name
+    :param sheet_range: range in Sheet format (example A1:E3 or A:E)
+    :param raw: keep values as read (dates and empty cells are not converted to text)
+    :return: generator of lists with row values
+    """
     min_col, max_col, min_row, max_row = get_ranges(sheet_range)
-    cells = ws.iter_rows(min_col=min_col, max_col=max_col, min_row=min_row, max_row=max_row)
+    wb = load_workbook(filename=file_path, read_only=True)
+    try:
+        ws = wb[sheet_name]
+        if max_row is None:
+            # don't trust the dimension saved in the file, read until the last row instead
+            ws.reset_dimensions()
 
-    values = []
-    for r in cells:
-        values_row = []
-        for c in r:
-            val = c.value
-            if val is None:
-                val = ''
+        for r in ws.iter_rows(min_col=min_col, max_col=max_col, min_row=min_row, max_row=max_row, values_only=True):
+            if raw:
+                yield r
+                continue
+            values_row = list(r)
+            for i, val in enumerate(values_row):
+                convert = converters.get(type(val))
+                if convert is not None:
+                    values_row[i] = convert(val)
+            yield values_row
+    finally:
+        wb.close()
 
-            if type(val) is datetime:
-                val = val.strftime('%d/%m/%Y')
-            values_row.append(val)
 
-        values.append(values_row)
+def read_sheet(file_path, sheet_name, sheet_range):
+    return list(iter_sheet(file_path, sheet_name, sheet_range))
 
-    return values
+
+def read_table(file_path, sheet_name, sheet_range):
+    """
+    Same values as read_sheet, kept in a (much smaller) SheetTable.
+    """
+    return SheetTable.from_rows(iter_sheet(file_path, sheet_name, sheet_range, raw=True))
 
 
 def open_sheet_keep_row(file_path, dest_path, sheet_name, starts_at, row_index):
@@ -78,6 +120,276 @@ def open_sheet_keep_row(file_path, dest_path, sheet_name, starts_at, row_index):
     wb.close()
 
 
+def _load_keep_rows(file_path, sheet_name, starts_at):
+    wb = load_workbook(filename=file_path)
+    for s in wb.sheetnames:
+        if s != sheet_name:
+            wb.remove(wb[s])
+
+    ws = wb[sheet_name]
+
+    # keep values, styles, comments, links and heights of data rows, then leave only the header
+    rows = []
+    heights = []
+    for r in ws.iter_rows(min_row=starts_at, max_row=ws.max_row):
+        rows.append([(c.value, copy(c._style), c.comment, c.hyperlink) for c in r])
+        heights.append(ws.row_dimensions[r[0].row].height)
+    ws.delete_rows(starts_at, ws.max_row)
+    # reading the heights added a dimension for every row, which would be saved as an empty row
+    for r in [r for r in ws.row_dimensions if r >= starts_at]:
+        del ws.row_dimensions[r]
+    # openpyxl only finds the column outline level while saving (and writes it from the second
+    # save on), found now so the first file is like the others
+    ws.column_dimensions.to_tree()
+    return wb, ws, rows, heights
+
+
+def _save_kept_row(wb, ws, rows, heights, starts_at, row_index, dest_path, compression=9, modified=None):
+    # row_index may also be a list of rows (kept one after another, in that order)
+    row_indexes = [row_index] if isinstance(row_index, int) else row_index
+    for offset, r in enumerate(row_indexes):
+        for col, (value, style, comment, hyperlink) in enumerate(rows[r], start=1):
+            cell = ws.cell(row=starts_at + offset, column=col)
+            cell.value = value
+            cell._style = copy(style)
+            # comments are copied by the cell when already bound to another one
+            cell.comment = comment
+            cell.hyperlink = copy(hyperlink)
+        ws.row_dimensions[starts_at + offset].height = heights[r]
+
+    # rows left by a previous (longer) save
+    last = starts_at + len(row_indexes) - 1
+    if ws.max_row > last:
+        for r in range(last + 1, ws.max_row + 1):
+            ws.row_dimensions.pop(r, None)
+        ws.delete_rows(last + 1, ws.max_row - last)
+
+    buffer = BytesIO()
+    wb.save(buffer)
+    content = compact_xlsx(buffer.getvalue(), compression, modified)
+    if dest_path is not None:
+        with open(dest_path, 'wb') as f:
+            f.write(content)
+    return content
+
+
+def keep_rows_generator(file_path, sheet_name, starts_at, targets, compression=9, modified=None):
+    """
+    Same result as open_sheet_keep_row, but parses the workbook only once for every row.
+    Files are built in memory and only written to disk when a dest_path is given.
+    :param file_path: source xlsx file
+    :param sheet_name: sheet to be kept
+    :param starts_at: line number where data starts (lines before are header)
+    :param targets: iterable of (row_index or list of row indexes, dest_path or None), consumed lazily
+    :param compression: zip compression level (see compact_xlsx)
+    :param modified: modification time saved in every file (default: now)
+    :return: generator yielding (content, error) for each target. error is None on success, otherwise
+             content is None: one bad row does not stop the others.
+    """
+    if modified is None:
+        modified = datetime.now(timezone.utc).replace(microsecond=0)
+    try:
+        wb, ws, rows, heights = _load_keep_rows(file_path, sheet_name, starts_at)
+    except Exception as e:
+        for _ in targets:
+            yield None, repr(e)
+        return
+    try:
+        for row_index, dest_path in targets:
+            try:
+                content = _save_kept_row(wb, ws, rows, heights, starts_at, row_index, dest_path, compression, modified)
+            except Exception as e:
+                yield None, repr(e)
+            else:
+                yield content, None
+    finally:
+        wb.close()
+
+
+# (workbook, sheet, rows, heights) loaded once by every worker process of keep_rows_parallel, or the load error
+_worker_sheet = None
+
+
+def _load_worker_sheet(file_path, sheet_name, starts_at):
+    global _worker_sheet
+    try:
+        _worker_sheet = _load_keep_rows(file_path, sheet_name, starts_at)
+    except Exception as e:
+        _worker_sheet = e
+
+
+def _keep_rows_chunk(starts_at, targets, compression, modified):
+    # Runs on a worker process. Errors are returned as text so one bad row does not stop the others.
+    if isinstance(_worker_sheet, Exception):
+        return [(None, repr(_worker_sheet)) for _ in targets]
+
+    wb, ws, rows, heights = _worker_sheet
+    results = []
+    for row_index, dest_path in targets:
+        try:
+            results.append((_save_kept_row(wb, ws, rows, heights, starts_at, row_index, dest_path, compression, modified), None))
+        except Exception as e:
+            results.append((None, repr(e)))
+    return results
+
+
+def keep_rows_parallel(file_path, sheet_name, starts_at, targets, workers, compression=9, modified=None):
+    """
+    Spreads keep_rows_generator work across a process pool. Every worker parses the workbook once,
+    then builds small chunks of rows. Only workers * 2 chunks are queued or waiting to be consumed,
+    so files are built as fast as they are sent (memory does not grow with the number of rows).
+    :param targets: list of (row_index or list of row indexes, dest_path or None)
+    :param workers: number of worker processes
+    :param modified: modification time saved in every file (default: now)
+    :return: generator yielding (content, error) in targets order. error is None on success.
+    """
+    chunk_size = max(1, min(32, -(-len(targets) // (workers * 4))))
+    # same timestamp in every worker, so equal rows give equal files
+    if modified is None:
+        modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+    targets = iter(targets)
+    futures = deque()
+    # the pool starts while sender and journal threads run, so workers are not forked from this
+    # process (a lock held by one of those threads would stay locked in the child)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                             initializer=_load_worker_sheet, initargs=(file_path, sheet_name, starts_at)) as executor:
+        while True:
+            while len(futures) < workers * 2:
+                chunk = list(islice(targets, chunk_size))
+                if not chunk:
+                    break
+                futures.append(executor.submit(_keep_rows_chunk, starts_at, chunk, compression, modified))
+            if not futures:
+                return
+            yield from futures.popleft().result()
+
+
+XLSX_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+# start tags with a cell format index: cells and rows (s="N") and columns (style="N")
+styled_pattern = re.compile(rb'<(?:c|row|col)\b[^>]*>')
+style_pattern = re.compile(rb'\b(s|style)="(\d+)"')
+# formulas of cells (f), data validations (formula1, formula2, also in x14 extensions as xm:f)
+# and conditional formatting (formula)
+formula_pattern = re.compile(rb'<((?:\w+:)?(?:f|formula[12]?))\b[^>]*>(.*?)</\1>', re.S)
+defined_name_pattern = re.compile(rb'<definedName\b[^>]*\bname="([^"]+)"[^>]*>(.*?)</definedName>', re.S)
+modified_pattern = re.compile(rb'(<dcterms:modified\b[^>]*>)[^<]*(</dcterms:modified>)')
+
+
+def compact_xlsx(content, compression=9, modified=None):
+    """
+    Removes from a saved workbook what its sheets do not use, which openpyxl copies from the source
+    workbook: cell formats (and their fonts, fills, borders and number formats) not used by any cell,
+    row or column, and defined names not used by formulas, data validations or conditional formatting.
+    Then recompresses the zip. (Strings need nothing: openpyxl saves them inline in the cells.)
+    :param content: xlsx file (bytes)
+    :param compression: zip compression level, 0 (stored) to 9
+    :param modified: datetime saved as modification time (in the zip and the document properties),
+                     so the same rows always give the same bytes. Default: kept as saved
+    :return: xlsx file (bytes)
+    """
+    source = zipfile.ZipFile(BytesIO(content))
+    files = {info.filename: source.read(info) for info in source.infolist()}
+    sheets = [name for name in files if name.startswith('xl/worksheets/') and name.endswith('.xml')]
+
+    used_styles = {int(s) for name in sheets for tag in styled_pattern.findall(files[name])
+                   for _, s in style_pattern.findall(tag)}
+    if 'xl/styles.xml' in files:
+        style_map, files['xl/styles.xml'] = _compact_styles(files['xl/styles.xml'], used_styles,
+                                                            any(b'dxfId=' in files[name] for name in sheets))
+        for name in sheets:
+            files[name] = styled_pattern.sub(lambda m: style_pattern.sub(
+                lambda s: b'%s="%d"' % (s.group(1), style_map[int(s.group(2))]), m.group(0)), files[name])
+
+    if 'xl/workbook.xml' in files:
+        formulas = b' '.join(m.group(2) for name in sheets for m in formula_pattern.finditer(files[name]))
+        files['xl/workbook.xml'] = defined_name_pattern.sub(
+            lambda m: m.group(0) if _uses_name(m.group(1), m.group(2), formulas) else b'', files['xl/workbook.xml'])
+
+    if modified is not None and 'docProps/core.xml' in files:
+        files['docProps/core.xml'] = modified_pattern.sub(
+            lambda m: m.group(1) + modified.strftime('%Y-%m-%dT%H:%M:%SZ').encode('ascii') + m.group(2), files['docProps/core.xml'])
+
+    buffer = BytesIO()
+    method = zipfile.ZIP_DEFLATED if compression > 0 else zipfile.ZIP_STORED
+    with zipfile.ZipFile(buffer, 'w', method, compresslevel=compression or None) as dest:
+        for info in source.infolist():
+            date_time = modified.timetuple()[:6] if modified is not None else info.date_time
+            dest.writestr(zipfile.ZipInfo(info.filename, date_time), files[info.filename], method, compression or None)
+    return buffer.getvalue()
+
+
+def _uses_name(name, value, formulas):
+    if name.startswith(b'_xlnm.'):
+        # print area and titles, dropped once they point to a deleted sheet
+        return b'#REF!' not in value
+    return re.search(rb'(?<![\w.])' + re.escape(name) + rb'(?![\w.(])', formulas) is not None
+
+
+def _keep_children(parent, indexes):
+    # leaves only the children at indexes, :return: dict old => new index
+    mapping = {}
+    for i, child in enumerate(list(parent)):
+        if i in indexes:
+            mapping[i] = len(mapping)
+        else:
+            parent.remove(child)
+    parent.set('count', str(len(mapping)))
+    return mapping
+
+
+def _renumber(elements, attribute, mapping):
+    for element in elements:
+        if element.get(attribute) is not None:
+            element.set(attribute, str(mapping.get(int(element.get(attribute)), 0)))
+
+
+def _compact_styles(styles, used, keep_dxfs):
+    # :return: dict old => new cell format index, and styles.xml without unused entries
+    ElementTree.register_namespace('', XLSX_NS)
+    root = ElementTree.fromstring(styles)
+
+    def find(tag):
+        return root.find('{{{}}}{}'.format(XLSX_NS, tag))
+
+    cell_xfs = find('cellXfs')
+    style_map = _keep_children(cell_xfs, used | {0}) if cell_xfs is not None else {}
+    cell_xfs = list(cell_xfs) if cell_xfs is not None else []
+
+    # named styles used by the kept formats
+    style_xfs = find('cellStyleXfs')
+    if style_xfs is not None:
+        named = _keep_children(style_xfs, {0} | {int(xf.get('xfId', 0)) for xf in cell_xfs})
+        _renumber(cell_xfs, 'xfId', named)
+        cell_styles = find('cellStyles')
+        if cell_styles is not None:
+            for cell_style in list(cell_styles):
+                if int(cell_style.get('xfId', 0)) not in named:
+                    cell_styles.remove(cell_style)
+            _renumber(cell_styles, 'xfId', named)
+            cell_styles.set('count', str(len(cell_styles)))
+        cell_xfs += list(style_xfs)
+
+    # fills 0 and 1 are reserved by Excel
+    for tag, attribute, reserved in (('fonts', 'fontId', {0}), ('fills', 'fillId', {0, 1}), ('borders', 'borderId', {0})):
+        parent = find(tag)
+        if parent is not None:
+            mapping = _keep_children(parent, reserved | {int(xf.get(attribute, 0)) for xf in cell_xfs})
+            _renumber(cell_xfs, attribute, mapping)
+
+    # custom number formats keep their ids
+    num_fmts = find('numFmts')
+    if num_fmts is not None:
+        used_formats = {xf.get('numFmtId') for xf in cell_xfs}
+        if not _keep_children(num_fmts, {i for i, fmt in enumerate(num_fmts) if fmt.get('numFmtId') in used_formats}):
+            root.remove(num_fmts)
+
+    dxfs = find('dxfs')
+    if dxfs is not None and not keep_dxfs:
+        _keep_children(dxfs, set())
+    return style_map, ElementTree.tostring(root)
+
 
 
 if __name__ == '__main__':
@@ -2,77 +2,179 @@ import os
 import pickle
 import re
 import sys
+import threading
 import urllib
 from urllib.parse import urlparse
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 import logging
 
+from sheet_table import HeaderIndex
+
 
 def sheet_id_from_url(url):
     return urlparse(url).path.split('/')[3]  # /spreadsheets/d/SHEET_ID/edit
 
 
-def read_sheet(credentials_path, sheet_url, sheet_range, download_sheet=None):
+class SheetsClient:
     """
-    Fetch Google Sheet values using specified range
-    :param credentials_path: json file containing google credentials
-    :param sheet_id: google sheet id
-    :param sheet_range: range in Sheet format (example A1:E3)
-    :return: array / sheet values
+    Long-lived Google client: one authorized HTTP connection (kept alive) shared by Sheets
+    value reads, Drive metadata and xlsx exports. Tokens are refreshed only when expired.
     """
-    sheet_id = sheet_id_from_url(sheet_url)
     # Source: https://developers.google.com/sheets/api/quickstart/python
-    creds = None
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        logging.info('Existing Google session token found')
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            logging.info('Session expired. Restarting session on Google')
-            creds.refresh(Request())
+    SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
+              'https://www.googleapis.com/auth/drive.metadata.readonly']
+
+    def __init__(self, credentials_path, token_path='token.pickle'):
+        """
+        :param credentials_path: json file containing google credentials
+        :param token_path: file where the session token is kept between runs
+        """
+        self.credentials_path = credentials_path
+        self.token_path = token_path
+        self.creds = None
+        self.http = None
+        self.sheets = None
+        self.drive = None
+        self.lock = threading.Lock()
+
+    def _authorize(self):
+        if self.creds is not None and self.creds.valid:
+            return
+
+        # the Google stack takes longer to import than a whole dry run, so it is only
+        # loaded when a Google Sheet is actually used
+        import httplib2
+        from google.auth.transport.requests import Request
+        from google_auth_httplib2 import AuthorizedHttp
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from googleapiclient.discovery import build
+
+        creds = self.creds
+        # The file token.pickle stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if creds is None and os.path.exists(self.token_path):
+            logging.info('Existing Google session token found')
+            with open(self.token_path, 'rb') as token:
+                creds = pickle.load(token)
+            if not creds.has_scopes(self.SCOPES):
+                logging.info('Google session token is missing required permissions')
+                creds = None
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                logging.info('Session expired. Restarting session on Google')
+                creds.refresh(Request())
+            else:
+                logging.info('Getting authorization from Google')
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.credentials_path, self.SCOPES)
+                creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            with open(self.token_path, 'wb') as token:
+                logging.info('Saving Google session token.')
+                pickle.dump(creds, token)
+
+        if creds is not self.creds:
+            self.creds = creds
+            # AuthorizedHttp refreshes the token by itself while the client lives
+            self.http = AuthorizedHttp(creds, http=httplib2.Http())
+            self.sheets = build('sheets', 'v4', http=self.http, cache_discovery=False).spreadsheets()
+            self.drive = build('drive', 'v3', http=self.http, cache_discovery=False).files()
+
+    def version(self, sheet_id):
+        """
+        :return: Drive file version (changes on every edit)
+        """
+        with self.lock:
+            self._authorize()
+            return self.drive.get(fileId=sheet_id, fields='version').execute()['version']
+
+    def batch_get(self, sheet_id, ranges):
+        """
+        Fetch several ranges (possibly from different sheets) with a single request.
+        :return: list of values, one per range
+        """
+        with self.lock:
+            self._authorize()
+            logging.info('Fetching spreadsheet data')
+            result = self.sheets.values().batchGet(spreadsheetId=sheet_id, ranges=ranges).execute()
+        return [r.get('values', []) for r in result.get('valueRanges', [])]
+
+    def export(self, sheet_url):
+        """
+        :return: spreadsheet content as xlsx
+        """
+        with self.lock:
+            self._authorize()
+            response, content = self.http.request(sheet_url.replace('edit', 'export'), 'GET')
+        if response.status != 200:
+            raise IOError('Could not export spreadsheet (HTTP {})'.format(response.status))
+        return content
+
+    def read_ranges(self, sheet_url, sheet_ranges, download_sheet=None, cache=None):
+        """
+        Fetch Google Sheet values for several ranges
+        :param sheet_url: google sheet url
+        :param sheet_ranges: ranges in Sheet format (example Page1!A1:E3)
+        :param download_sheet: path where the exported xlsx is saved (optional)
+        :param cache: SheetCache. If the Drive file version did not change, cached values (and export) are used
+        :return: list of array / sheet values, one per range
+        """
+        sheet_id = sheet_id_from_url(sheet_url)
+        values = [None] * len(sheet_ranges)
+        content = None
+        version = None
+        if cache is not None:
+            version = self.version(sheet_id)
+            values = [cache.get_values(sheet_id, r, version) for r in sheet_ranges]
+            if download_sheet is not None:
+                content = cache.get_export(sheet_id, version)
+
+        missing = [i for i, v in enumerate(values) if v is None]
+        if missing:
+            fetched = self.batch_get(sheet_id, [sheet_ranges[i] for i in missing])
+            for i, v in zip(missing, fetched):
+                values[i] = v
+                logging.debug(v)
+                if cache is not None:
+                    cache.put_values(sheet_id, sheet_ranges[i], version, v)
         else:
-            logging.info('Getting authorization from Google')
-            flow = InstalledAppFlow.from_client_secrets_file(
-                credentials_path, SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            logging.info('Saving Google session token.')
-            pickle.dump(creds, token)
+            logging.info('Spreadsheet unchanged (version {}). Using cached data'.format(version))
 
-    service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
-    # Call the Sheets API
-    sheet = service.spreadsheets()
-    logging.info('Fetching spreadsheet data')
-    result = sheet.values().get(spreadsheetId=sheet_id,
-                                range=sheet_range).execute()
-    values = result.get('values', [])
-    logging.debug(values)
+        if download_sheet is not None:
+            if content is None:
+                content = self.export(sheet_url)
+                if cache is not None:
+                    cache.put_export(sheet_id, version, content)
+            with open(download_sheet, 'wb') as csvFile:
+                csvFile.write(content)
 
-    if download_sheet is not None:
-        from google.auth.transport.requests import AuthorizedSession
+        return values
 
-        authed_session = AuthorizedSession(creds)
-        exportUrl = sheet_url.replace('edit', 'export')
 
-        url = exportUrl
+clients = {}
 
-        response = authed_session.request(
-            'GET', url)
 
-        with open(download_sheet, 'wb') as csvFile:
-            csvFile.write(response.content)
+def get_client(credentials_path):
+    """
+    :return: SheetsClient shared by every call using the same credentials
+    """
+    if credentials_path not in clients:
+        clients[credentials_path] = SheetsClient(credentials_path)
+    return clients[credentials_path]
 
-    return values
+
+def read_sheet(credentials_path, sheet_url, sheet_range, download_sheet=None, cache=None):
+    """
+    Fetch Google Sheet values using specified range
+    :param credentials_path: json file containing google credentials
+    :param sheet_id: google sheet id
+    :param sheet_range: range in Sheet format (example A1:E3)
+    :param download_sheet: path where the exported xlsx is saved (optional)
+    :param cache: SheetCache. If the Drive file version did not change, cached values (and export) are used
+    :return: array / sheet values
+    """
+    return get_client(credentials_path).read_ranges(sheet_url, [sheet_range], download_sheet, cache)[0]
 
 
 def get_header_lines_number(header_lines):
@@ -97,26 +199,7 @@ def get_header_columns(data, header_lines):
     :param header_lines: interval (line number) where is header contained.
     :return: dict containing column index (key) with header name (value)
     """
-    header_names = {}
     line_start, line_end = get_header_lines_number(header_lines)
-
-    header_size = 0
-    for l in range(line_start, line_end+1):
-        if len(data[l]) > header_size:
-            header_size = len(data[l])
-
-    for l in range(line_start, line_end+1):
-        if len(data[l]) != header_size:
-            continue
-
-        for c in range(0, len(data[l])):
-            if data[l][c].strip() == '':
-                continue
-
-            if c not in header_names:
-                header_names[c] = data[l][c]
-            else:
-                header_names[c] = header_names[c] + ' ' + data[l][c]
-            header_names[c] = header_names[c].strip()
+    header_names = HeaderIndex.from_rows(data[l] for l in range(line_start, line_end + 1)).columns
     logging.debug(header_names)
     return header_names
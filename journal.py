@@ -0,0 +1,81 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def journal_key(sheet, row, recipient, content):
+    """
+    Identifies one delivered mail.
+    :param sheet: sheet identifier (url or file path plus sheet name)
+    :param row: row index in sheet data
+    :param recipient: mail to field
+    :param content: anything that changes the mail (row values, subject, message)
+    :return: key string
+    """
+    digest = hashlib.sha1(json.dumps(content, default=str, sort_keys=True).encode('utf-8')).hexdigest()
+    return '{}|{}|{}|{}'.format(sheet, row, recipient, digest)
+
+
+class SendJournal:
+    """
+    Append-only record of delivered mails, stored in SQLite. Used by --resume to skip rows
+    already sent by a previous (possibly interrupted) run.
+    Inserts are committed in batches; every commit is fsync'd (WAL, synchronous=FULL). A batch is
+    also committed when no more mails are recorded for batch_interval seconds, by flush (end of a
+    send) and by close.
+    """
+    def __init__(self, path, batch_size=20, batch_interval=1.0):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sent (key TEXT PRIMARY KEY, sent_at REAL)')
+        self.connection.commit()
+        self.delivered = set(row[0] for row in self.connection.execute('SELECT key FROM sent'))
+        self.unsaved = 0
+        self.last_commit = time.monotonic()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_idle, daemon=True)
+        self.flusher.start()
+
+    def __contains__(self, key):
+        return key in self.delivered
+
+    def record(self, key):
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO sent VALUES (?, ?)', (key, time.time()))
+            self.delivered.add(key)
+            self.unsaved += 1
+            if self.unsaved >= self.batch_size or time.monotonic() - self.last_commit >= self.batch_interval:
+                self._commit()
+
+    def flush(self):
+        """
+        Commits the mails recorded since the last commit.
+        """
+        with self.lock:
+            if self.unsaved:
+                self._commit()
+
+    def _flush_idle(self):
+        # the last batch of a burst is committed without waiting for another record
+        while not self.closed.wait(self.batch_interval):
+            with self.lock:
+                if self.unsaved and time.monotonic() - self.last_commit >= self.batch_interval:
+                    self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self.unsaved = 0
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        with self.lock:
+            self._commit()
+            self.connection.close()
@@ -0,0 +1,341 @@
+import asyncio
+import base64
+import smtplib
+import socket
+import ssl
+import time
+
+from mail_send import SendPool, SendResult, data_blocks, drops_connection
+from metrics import metrics
+
+
+class AsyncSMTPConnection:
+    """
+    SMTP client session on asyncio streams. When the server advertises PIPELINING, MAIL FROM,
+    every RCPT TO and DATA are written together and their replies read afterwards, so a mail
+    costs one round trip before the message data whatever the number of recipients.
+    Errors are raised as the same smtplib exceptions used by EmailBackend.
+    """
+    def __init__(self, host, port, use_ssl=False, use_tls=False, local_hostname=None, timeout=60):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.local_hostname = local_hostname or socket.getfqdn()
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_ssl or self.use_tls else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context if self.use_ssl else None), self.timeout)
+        code, resp = await self._reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, resp)
+        await self._ehlo()
+
+        if self.use_tls and not self.use_ssl:
+            if 'starttls' not in self.extensions:
+                raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+            code, resp = await self._command('STARTTLS')
+            if code != 220:
+                raise smtplib.SMTPResponseException(code, resp)
+            # StreamWriter.start_tls needs Python 3.11
+            await self.writer.start_tls(context, server_hostname=self.host)
+            await self._ehlo()
+
+    async def login(self, user, password):
+        methods = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in methods:
+            token = base64.b64encode('\0{}\0{}'.format(user, password).encode('utf-8')).decode('ascii')
+            code, resp = await self._command('AUTH PLAIN ' + token)
+        elif 'LOGIN' in methods:
+            code, resp = await self._command('AUTH LOGIN')
+            for value in (user, password):
+                if code != 334:
+                    break
+                code, resp = await self._command(base64.b64encode(value.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPNotSupportedError('No suitable authentication method found.')
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def sendmail(self, from_addr, to_addrs, chunks):
+        """
+        Same as mail_send.sendmail_chunks.
+        :return: dict with refused recipients
+        """
+        mail = 'MAIL FROM:<{}>'.format(from_addr)
+        rcpts = ['RCPT TO:<{}>'.format(a) for a in to_addrs]
+        data_reply = None
+        if 'pipelining' in self.extensions:
+            self.writer.write(''.join(c + '\r\n' for c in [mail] + rcpts + ['DATA']).encode('utf-8'))
+            await self.writer.drain()
+            code, resp = await self._reply()
+            rcpt_replies = [await self._reply() for _ in rcpts]
+            data_reply = await self._reply()
+        else:
+            # one command at a time, stopping at the first fatal reply like smtplib
+            code, resp = await self._command(mail)
+            rcpt_replies = []
+            for command in rcpts if code == 250 else []:
+                rcpt_replies.append(await self._command(command))
+                if rcpt_replies[-1][0] == 421:
+                    break
+        # only known here when pipelined
+        data_code = data_reply[0] if data_reply else None
+
+        if code != 250:
+            await self._abort(code, data_code)
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        senderrs = {a: r for a, r in zip(to_addrs, rcpt_replies) if r[0] not in (250, 251)}
+        disconnected = any(r[0] == 421 for r in senderrs.values())
+        if disconnected or len(senderrs) == len(to_addrs):
+            await self._abort(421 if disconnected else 550, data_code)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+
+        if data_reply is None:
+            data_reply = await self._command('DATA')
+        if data_reply[0] != 354:
+            await self._abort(data_reply[0], None)
+            raise smtplib.SMTPDataError(*data_reply)
+
+        for block in data_blocks(chunks):
+            self.writer.write(block)
+            await self.writer.drain()
+
+        code, resp = await self._reply()
+        if code != 250:
+            await self._abort(code, None)
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+    async def quit(self):
+        try:
+            await self._command('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _abort(self, code, data_code):
+        # leaves the session ready for the next mail (or closed)
+        if code == 421:
+            self.close()
+            return
+        try:
+            if data_code == 354:
+                # server accepted a pipelined DATA anyway, end it with an empty message
+                self.writer.write(b'.\r\n')
+                await self._reply()
+            await self._command('RSET')
+        except (OSError, smtplib.SMTPException):
+            self.close()
+
+    async def _ehlo(self):
+        code, resp = await self._command('EHLO ' + self.local_hostname)
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, resp)
+        self.extensions = {}
+        for line in resp.decode('latin-1').split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            self.extensions[name.lower()] = params
+
+    async def _command(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self._reply()
+
+    async def _reply(self):
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise TimeoutError('SMTP server did not reply in {}s'.format(self.timeout))
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+
+class AsyncEmailBackend(SendPool):
+    """
+    Same contract as PooledEmailBackend (see SendPool), but every connection is a coroutine on one
+    event loop instead of a thread. Messages are still pulled from the (blocking) iterable on a helper
+    thread, so they are prepared while others are being sent. With keep_alive, the event loop and its
+    connections are kept between send_messages calls, until close.
+    """
+    local_hostname = None
+    loop = None
+
+    def close(self):
+        """
+        Closes connections kept open by keep_alive.
+        """
+        if self.loop is not None:
+            self.loop.run_until_complete(self._close_idle())
+            self._close_loop(self.loop)
+            self.loop = None
+
+    def send_messages(self, email_messages):
+        if self.local_hostname is None:
+            self.local_hostname = socket.getfqdn()
+        loop = self.loop or asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._send_all(email_messages))
+        finally:
+            if self.keep_alive:
+                self.loop = loop
+            else:
+                self._close_loop(loop)
+
+    @staticmethod
+    def _close_loop(loop):
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+    async def _close_idle(self):
+        while self.idle:
+            connection, _ = self.idle.pop()
+            await self._close(connection)
+
+    async def _send_all(self, email_messages):
+        pending = asyncio.Queue(maxsize=self.queue_size)
+        retries = asyncio.Queue()
+        done = asyncio.Event()
+        results = []
+        errors = []
+        workers = [asyncio.ensure_future(self._worker(pending, retries, done, results, errors))
+                   for _ in range(self.connections)]
+
+        loop = asyncio.get_running_loop()
+        messages = iter(email_messages)
+        index = 0
+        try:
+            while True:
+                message = await loop.run_in_executor(None, next, messages, None)
+                if message is None:
+                    break
+                item = (index, message, 0, 0)
+                index += 1
+                # wait for room in the queue, unless every connection failed to open
+                put = asyncio.ensure_future(pending.put(item))
+                alive = [w for w in workers if not w.done()]
+                while alive and not put.done():
+                    await asyncio.wait([put] + alive, return_when=asyncio.FIRST_COMPLETED)
+                    alive = [w for w in alive if not w.done()]
+                if not put.done():
+                    put.cancel()
+                    results.append(self._unsent(item, errors))
+                    self._stop_messages(messages)
+                    break
+        finally:
+            # also when preparing a message raised: workers send what was queued and stop
+            done.set()
+            await asyncio.gather(*workers)
+            self._flush_journal()
+
+        return self._finish(results, (pending, retries), errors)
+
+    async def _open(self):
+        connection = AsyncSMTPConnection(self.host, self.port, self.use_ssl, self.use_tls, self.local_hostname)
+        with metrics.timer('smtp_connect', host=self.host):
+            await connection.connect()
+        if self.username and self.password:
+            with metrics.timer('smtp_login'):
+                await connection.login(self.username, self.password)
+        return connection
+
+    async def _send(self, connection, message):
+        if not message.recipients():
+            return False
+        with metrics.timer('mime_build'):
+            chunks = message.message_chunks()
+        with metrics.timer('sendmail', to=message.to):
+            await connection.sendmail(message.from_email, message.recipients(), chunks)
+        metrics.count('sent')
+        metrics.count('bytes_sent', sum(len(c) for c in chunks))
+        if self.journal is not None and message.journal_key is not None:
+            self.journal.record(message.journal_key)
+        return True
+
+    async def _worker(self, pending, retries, done, results, errors):
+        connection, sent_on_connection = self.idle.pop() if self.idle else (None, 0)
+        try:
+            while True:
+                if not retries.empty():
+                    item = retries.get_nowait()
+                else:
+                    try:
+                        item = await asyncio.wait_for(pending.get(), 0.1)
+                    except asyncio.TimeoutError:
+                        if done.is_set():
+                            return
+                        continue
+                index, message, attempt, not_before = item
+
+                delay = not_before - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                if connection is None or connection.writer is None or sent_on_connection == self.max_messages_per_connection:
+                    if connection is not None:
+                        await self._close(connection)
+                    try:
+                        connection = await self._open()
+                    except (OSError, smtplib.SMTPException) as e:
+                        connection = None
+                        if self._connect_failed(item, e, results, errors, retries):
+                            continue
+                        return
+                    sent_on_connection = 0
+
+                if self.rate_limiter is not None:
+                    while True:
+                        wait = self.rate_limiter.try_acquire()
+                        if wait <= 0:
+                            break
+                        await asyncio.sleep(wait)
+
+                print('Sending mail to {}...'.format(message.to))
+                try:
+                    try:
+                        sent = await self._send(connection, message)
+                    except (smtplib.SMTPServerDisconnected, ConnectionError):
+                        # also happens to connections closed by the server while idle
+                        connection.close()
+                        connection = await self._open()
+                        sent_on_connection = 0
+                        sent = await self._send(connection, message)
+                    results.append(SendResult(index, message.to, sent, None))
+                except (OSError, smtplib.SMTPException) as e:
+                    retry = self._send_failed(item, e, results)
+                    if retry is not None:
+                        if drops_connection(e):
+                            connection.close()
+                        retries.put_nowait(retry)
+                sent_on_connection += 1
+        finally:
+            if self.keep_alive and connection is not None and connection.writer is not None:
+                self.idle.append((connection, sent_on_connection))
+            elif connection is not None:
+                await self._close(connection)
+
+    async def _close(self, connection):
+        if connection.writer is None:
+            return
+        try:
+            await connection.quit()
+        except (OSError, smtplib.SMTPException):
+            connection.close()
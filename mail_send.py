@@ -1,8 +1,13 @@
 # Based on: https://github.com/django/django/blob/master/django/core/mail/backends/smtp.py
 # and https://docs.djangoproject.com/pt-br/3.0/_modules/django/core/mail/message/
+import hashlib
+import logging
 import mimetypes
-import smtplib
-import ssl
+import queue
+import random
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from email import message_from_string, encoders, generator, charset
 from email.message import Message
 from email.mime.base import MIMEBase
@@ -13,14 +18,21 @@ from pathlib import Path
 from email.mime.message import MIMEMessage
 from email.mime.text import MIMEText
 
+from metrics import metrics
+
 
 email_providers = {'outlook': {'host': 'smtp.office365.com', 'port': 587, 'use_tls': True},
                    'gmail': {'host': 'smtp.gmail.com', 'port': 587, 'use_tls': True}
                   }
 
+# Default sending limits, can be overridden with rate-limit in the email section of config.yml
+provider_limits = {'outlook': {'per-minute': 30, 'per-day': 10000},
+                   'gmail': {'per-minute': 20, 'per-day': 500}
+                  }
+
 
 class EmailBackend:
-    def __init__(self, host, port, username, password, use_ssl=False, use_tls=False, fail_silently=False):
+    def __init__(self, host, port, username, password, use_ssl=False, use_tls=False, fail_silently=False, journal=None):
         self.host = host
         self.port = port
         self.username = username
@@ -29,19 +41,25 @@ class EmailBackend:
         self.use_tls = use_tls
         self.connection = None
         self.fail_silently = fail_silently
+        self.journal = journal
 
     def open_connection(self):
-        self.connection = self.connection_class(self.host, self.port)
+        with metrics.timer('smtp_connect', host=self.host):
+            self.connection = self.connection_class(self.host, self.port)
 
-        if not self.use_ssl and self.use_tls:
-            self.connection.starttls()
+            if not self.use_ssl and self.use_tls:
+                self.connection.starttls()
 
         if self.username and self.password:
-            self.connection.login(user=self.username, password=self.password)
+            with metrics.timer('smtp_login'):
+                self.connection.login(user=self.username, password=self.password)
 
         return self.connection
 
     def close_connection(self):
+        import smtplib
+        import ssl
+
         if self.connection is None:
             return
         try:
@@ -80,25 +98,361 @@ class EmailBackend:
 
     @property
     def connection_class(self):
+        import smtplib
+
         return smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
 
     def _send(self, email_message):
         """A helper method that does the actual sending."""
+        import smtplib
+
         if not email_message.recipients():
             return False
         encoding = email_message.encoding or charset.Charset('utf-8')
         from_email = email_message.from_email
         recipients = email_message.recipients()
-        message = email_message.message()
+        with metrics.timer('mime_build'):
+            chunks = email_message.message_chunks()
         try:
-            self.connection.sendmail(from_email, recipients, as_bytes(message, linesep='\r\n'))
+            with metrics.timer('sendmail', to=email_message.to):
+                sendmail_chunks(self.connection, from_email, recipients, chunks)
         except smtplib.SMTPException:
             if not self.fail_silently:
                 raise
             return False
+        metrics.count('sent')
+        metrics.count('bytes_sent', sum(len(c) for c in chunks))
+
+        if self.journal is not None and email_message.journal_key is not None:
+            self.journal.record(email_message.journal_key)
         return True
 
 
+SendResult = namedtuple('SendResult', ['index', 'to', 'sent', 'error'])
+
+
+def is_temporary_error(error):
+    """
+    Check if a sending error is worth retrying later (4xx replies, dropped connections).
+    """
+    import smtplib
+
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError))
+
+
+def _drop_connection(backend):
+    import smtplib
+
+    # close_connection always forgets the connection, even when quit() fails
+    try:
+        backend.close_connection()
+    except (OSError, smtplib.SMTPException):
+        pass
+
+
+class TokenBucket:
+    def __init__(self, limit, period):
+        self.capacity = limit
+        self.rate = limit / period
+        self.tokens = float(limit)
+
+    def refill(self, elapsed):
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def wait_time(self):
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Shared by every connection of a sender. Each message takes a token from a per-minute
+    and a per-day bucket, and the whole sender can be paused when the server throttles.
+    """
+    def __init__(self, per_minute=None, per_day=None):
+        self.buckets = [TokenBucket(limit, period) for limit, period in ((per_minute, 60), (per_day, 24 * 60 * 60)) if limit]
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        :return: 0 if a token was taken, otherwise seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            for b in self.buckets:
+                b.refill(now - self.updated)
+            self.updated = now
+
+            wait = max([self.paused_until - now] + [b.wait_time() for b in self.buckets])
+            if wait <= 0:
+                for b in self.buckets:
+                    b.tokens -= 1
+                return 0
+            return wait
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, delay):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+def drops_connection(error):
+    """
+    Check if the connection can not be used after a sending error (421 replies, dropped connections).
+    """
+    import smtplib
+
+    # SMTPException is an OSError too, but other replies leave the session usable (see sendmail_chunks)
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code == 421 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class SendPool:
+    """
+    Scheduling shared by the sending engines (PooledEmailBackend and mail_async.AsyncEmailBackend).
+    Messages are numbered as they are pulled from the iterable and queued for the connections;
+    temporary errors are retried later with exponential backoff, and a SendResult is kept for every
+    message in self.results, in the same order messages were given. Sending errors never raise.
+    Queue items are (index, message, attempt, not_before).
+    """
+    def __init__(self, host, port, username, password, use_ssl=False, use_tls=False, journal=None, connections=1,
+                 max_messages_per_connection=None, rate_limiter=None, max_retries=5, backoff=2.0, max_backoff=300.0,
+                 queue_size=None, keep_alive=False):
+        """
+        :param connections: connections sending in parallel
+        :param max_messages_per_connection: connections are opened again after this number of messages
+        :param rate_limiter: RateLimiter shared by every connection (None: no limit)
+        :param queue_size: messages prepared ahead of sending (default: connections * 2)
+        :param keep_alive: keep connections open between send_messages calls, until close
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.journal = journal
+        self.connections = connections
+        self.max_messages_per_connection = max_messages_per_connection
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue_size = queue_size or connections * 2
+        self.keep_alive = keep_alive
+        self.idle = []  # (connection, sent count) kept between send_messages calls (keep_alive)
+        self.results = []
+
+    def _send_failed(self, item, error, results):
+        """
+        Records a failed attempt to send a message.
+        :return: item to queue again, sent after a backoff delay, or None if the failure is final (added to results)
+        """
+        index, message, attempt, _ = item
+        metrics.count('error.' + type(error).__name__)
+        if not is_temporary_error(error) or attempt >= self.max_retries:
+            results.append(SendResult(index, message.to, False, error))
+            return None
+
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        logging.warning('Temporary error sending mail to {} ({}). Retrying in {:.1f}s'.format(message.to, error, delay))
+        metrics.count('retries')
+
+        # the limit is per account, so every connection slows down
+        if self.rate_limiter is not None:
+            self.rate_limiter.pause(delay)
+        return index, message, attempt + 1, time.monotonic() + delay
+
+    def _connect_failed(self, item, error, results, errors, retries):
+        """
+        Handles a connection that could not be opened (or logged in) to send item. Temporary errors
+        (refused connections, 4xx greetings) are retried with backoff like sending errors.
+        :param retries: queue of items to send again
+        :return: True if the worker keeps going, False if it must stop (permanent error, or retries used up)
+        """
+        if is_temporary_error(error):
+            retry = self._send_failed(item, error, results)
+            if retry is not None:
+                retries.put_nowait(retry)
+                return True
+            errors.append(error)
+            return False
+
+        metrics.count('error.' + type(error).__name__)
+        # give the message back to the other connections
+        errors.append(error)
+        retries.put_nowait(item)
+        return False
+
+    def _flush_journal(self):
+        # mails delivered by this call are committed before it returns (or raises)
+        if self.journal is not None:
+            self.journal.flush()
+
+    def _stop_messages(self, messages):
+        """
+        Called once every connection failed: the messages left are not prepared at all (a generator
+        is closed, which also stops its attachment workers) and get no SendResult.
+        """
+        logging.error('No SMTP connection left, the remaining mails are not sent')
+        close = getattr(messages, 'close', None)
+        if close is not None:
+            close()
+
+    def _unsent(self, item, errors):
+        # message given up because no connection could be opened
+        index, message, _, _ = item
+        return SendResult(index, message.to, False, errors[-1] if errors else None)
+
+    def _finish(self, results, queues, errors):
+        """
+        :param queues: pending and retry queues, holding the messages left when every connection failed
+        :return: number of messages sent
+        """
+        for q in queues:
+            while not q.empty():
+                results.append(self._unsent(q.get_nowait(), errors))
+        results.sort(key=lambda r: r.index)
+        self.results = results
+        return sum(1 for r in results if r.sent)
+
+
+class PooledEmailBackend(SendPool):
+    """
+    Sends messages over several persistent connections, one thread per connection.
+    Messages may come from any iterable (e.g. a generator): they are pulled through a bounded
+    queue, so sending starts with the first message and only a few are held in memory.
+    """
+    def _new_backend(self):
+        """
+        :return: (backend, messages already sent on its connection)
+        """
+        try:
+            return self.idle.pop()
+        except IndexError:
+            # errors are collected per message, so the per-connection backend always raises
+            return EmailBackend(self.host, self.port, self.username, self.password, self.use_ssl, self.use_tls,
+                                journal=self.journal), 0
+
+    def close(self):
+        """
+        Closes connections kept open by keep_alive.
+        """
+        while self.idle:
+            backend, _ = self.idle.pop()
+            _drop_connection(backend)
+
+    def send_messages(self, email_messages):
+        pending = queue.Queue(maxsize=self.queue_size)
+        retries = queue.Queue()
+        done = threading.Event()
+        results = []
+        errors = []
+        workers = [threading.Thread(target=self._worker, args=(pending, retries, done, results, errors))
+                   for _ in range(self.connections)]
+        for w in workers:
+            w.start()
+
+        messages = iter(email_messages)
+        try:
+            for index, message in enumerate(messages):
+                item = (index, message, 0, 0)
+                while any(w.is_alive() for w in workers):
+                    try:
+                        pending.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                else:
+                    # every connection failed to open
+                    results.append(self._unsent(item, errors))
+                    self._stop_messages(messages)
+                    break
+        finally:
+            # also when preparing a message raised: workers send what was queued and stop
+            done.set()
+            for w in workers:
+                w.join()
+            self._flush_journal()
+
+        return self._finish(results, (pending, retries), errors)
+
+    def _worker(self, pending, retries, done, results, errors):
+        import smtplib
+
+        backend, sent_on_connection = self._new_backend()
+        try:
+            while True:
+                try:
+                    item = retries.get_nowait()
+                except queue.Empty:
+                    try:
+                        item = pending.get(timeout=0.1)
+                    except queue.Empty:
+                        if done.is_set():
+                            return
+                        continue
+                index, message, attempt, not_before = item
+
+                delay = not_before - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                if backend.connection is None or sent_on_connection == self.max_messages_per_connection:
+                    backend.close_connection()
+                    try:
+                        backend.open_connection()
+                    except (OSError, smtplib.SMTPException) as e:
+                        backend.connection = None
+                        if self._connect_failed(item, e, results, errors, retries):
+                            continue
+                        return
+                    sent_on_connection = 0
+
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+
+                print('Sending mail to {}...'.format(message.to))
+                try:
+                    try:
+                        sent = backend._send(message)
+                    except (smtplib.SMTPServerDisconnected, ConnectionError):
+                        # also happens to idle connections closed by the server
+                        _drop_connection(backend)
+                        backend.open_connection()
+                        sent_on_connection = 0
+                        sent = backend._send(message)
+                    results.append(SendResult(index, message.to, sent, None))
+                except (OSError, smtplib.SMTPException) as e:
+                    retry = self._send_failed(item, e, results)
+                    if retry is not None:
+                        if drops_connection(e):
+                            _drop_connection(backend)
+                        retries.put(retry)
+                sent_on_connection += 1
+        finally:
+            if self.keep_alive and backend.connection is not None:
+                self.idle.append((backend, sent_on_connection))
+            else:
+                backend.close_connection()
+
+
 def as_bytes(message, unixfrom=False, linesep='\n'):
     fp = BytesIO()
     g = generator.BytesGenerator(fp, mangle_from_=False)
@@ -106,11 +460,124 @@ def as_bytes(message, unixfrom=False, linesep='\n'):
     return fp.getvalue()
 
 
+def _digest(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8', 'surrogateescape')
+    return hashlib.sha1(content).digest()
+
+
+class EncodedPartCache:
+    """
+    LRU cache of MIME parts already flattened to bytes (CRLF line endings), keyed by content hash.
+    """
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.parts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, create_part):
+        with self.lock:
+            if key in self.parts:
+                self.parts.move_to_end(key)
+                return self.parts[key]
+
+        data = as_bytes(create_part(), linesep='\r\n')
+        with self.lock:
+            self.parts[key] = data
+            if len(self.parts) > self.max_entries:
+                self.parts.popitem(last=False)
+        return data
+
+
+encoded_parts = EncodedPartCache()
+
+
+SEND_BUFFER_SIZE = 64 * 1024
+
+
+def data_blocks(chunks):
+    """
+    Message chunks ready to be written after DATA: dot-stuffed (RFC 5321 4.5.2), keeping track of
+    chunks that start in the middle of a line, and ending with the final dot line.
+    Small chunks are grouped: many tiny writes stall on Nagle / delayed ACK.
+    """
+    at_line_start = True
+    buffered = []
+    buffered_size = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        quoted = chunk.replace(b'\n.', b'\n..')
+        if at_line_start and chunk.startswith(b'.'):
+            quoted = b'.' + quoted
+        buffered.append(quoted)
+        buffered_size += len(quoted)
+        if buffered_size >= SEND_BUFFER_SIZE:
+            yield b''.join(buffered)
+            buffered = []
+            buffered_size = 0
+        at_line_start = chunk.endswith(b'\n')
+    buffered.append(b'.\r\n' if at_line_start else b'\r\n.\r\n')
+    yield b''.join(buffered)
+
+
+def sendmail_chunks(connection, from_addr, to_addrs, chunks):
+    """
+    Same as smtplib.SMTP.sendmail, but message is given as byte blocks (with CRLF line endings)
+    which are written straight to the socket, without joining the whole message in memory.
+    """
+    import smtplib
+
+    connection.ehlo_or_helo_if_needed()
+    code, resp = connection.mail(from_addr)
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            connection._rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    senderrs = {}
+    for each in to_addrs:
+        code, resp = connection.rcpt(each)
+        if code != 250 and code != 251:
+            senderrs[each] = (code, resp)
+        if code == 421:
+            connection.close()
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+    if len(senderrs) == len(to_addrs):
+        # the server refused all our recipients
+        connection._rset()
+        raise smtplib.SMTPRecipientsRefused(senderrs)
+
+    code, resp = connection.docmd('data')
+    if code != 354:
+        if code == 421:
+            connection.close()
+        else:
+            connection._rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    for block in data_blocks(chunks):
+        connection.send(block)
+
+    code, resp = connection.getreply()
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            connection._rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return senderrs
+
+
 class EmailMessage:
     """A container for email information."""
     content_subtype = 'plain'
     mixed_subtype = 'mixed'
     encoding = None     # None => use settings default
+    journal_key = None  # set for mails built from a sheet row, see journal.journal_key
+    rows = None         # indexes of the sheet data rows sent, set by mail_util.iter_mails
 
     def __init__(self, subject='', body='', from_email=None, to=None, bcc=None,
                  attachments=None, headers=None, cc=None,
@@ -159,6 +626,49 @@ class EmailMessage:
         encoding = self.encoding
         msg = MIMEText(self.body, self.content_subtype, encoding)
         msg = self._create_message(msg)
+        return self._set_headers(msg)
+
+    def message_chunks(self):
+        """
+        Same bytes as as_bytes(self.message(), linesep='\r\n'), split in blocks so they can be
+        written to the connection one by one. Body and attachment parts are encoded once and
+        reused (see encoded_parts) by every message with the same content, whatever the file name.
+        """
+        if not self.attachments:
+            return [as_bytes(self.message(), linesep='\r\n')]
+
+        parts = []
+        if self.body:
+            key = ('body', self.content_subtype, self.encoding, _digest(self.body))
+            parts.append(encoded_parts.get(key, lambda: MIMEText(self.body, self.content_subtype, self.encoding)))
+        for attachment in self.attachments:
+            if isinstance(attachment, MIMEBase):
+                parts.append(as_bytes(attachment, linesep='\r\n'))
+            else:
+                filename, content, mimetype = attachment
+                key = ('attachment', mimetype, self.encoding, _digest(content))
+                part = encoded_parts.get(key, lambda: self._create_mime_attachment(content, mimetype))
+                parts.append(self._add_disposition(part, filename))
+
+        boundary = generator._make_boundary()
+        while any(boundary.encode('ascii') in p for p in parts):
+            boundary = generator._make_boundary()
+
+        msg = MIMEMultipart(_subtype=self.mixed_subtype, encoding=self.encoding, boundary=boundary)
+        msg = self._set_headers(msg)
+        policy = msg.policy.clone(linesep='\r\n')
+        headers = b''.join(policy.fold_binary(name, value) for name, value in msg.raw_items())
+
+        delimiter = '\r\n--{}\r\n'.format(boundary).encode('ascii')
+        chunks = [headers + delimiter]
+        for i, part in enumerate(parts):
+            if i > 0:
+                chunks.append(delimiter)
+            chunks.append(part)
+        chunks.append('\r\n--{}--\r\n'.format(boundary).encode('ascii'))
+        return chunks
+
+    def _set_headers(self, msg):
         msg['Subject'] = self.subject
         msg['From'] = self.extra_headers.get('From', self.from_email)
         self._set_list_header_if_not_empty(msg, 'To', self.to)
@@ -292,6 +802,22 @@ class EmailMessage:
             attachment.add_header('Content-Disposition', 'attachment', filename=filename)
         return attachment
 
+    def _add_disposition(self, part, filename):
+        """
+        Adds to an encoded part (bytes) the Content-Disposition header _create_attachment would add.
+        """
+        if not filename:
+            return part
+        try:
+            filename.encode('ascii')
+        except UnicodeEncodeError:
+            filename = ('utf-8', '', filename)
+        disposition = Message()
+        disposition.add_header('Content-Disposition', 'attachment', filename=filename)
+        # headers end at the first empty line, the added one goes last like in _create_attachment
+        end = part.index(b'\r\n\r\n') + 2
+        return part[:end] + as_bytes(disposition, linesep='\r\n')[:-2] + part[end:]
+
     def _set_list_header_if_not_empty(self, msg, header, values):
         """
         Set msg's header, either from self.extra_headers, if present, or from
@@ -305,7 +831,7 @@ class EmailMessage:
             msg[header] = value
 
     def __str__(self):
-        return '[subject={}, from={}, to={}, body={}]'.format(self.subject, self.from_email, self.to, self.body)
+        return '[subject={}, from={}, to={}, cc={}, body={}]'.format(self.subject, self.from_email, self.to, self.cc, self.body)
 
 
 class EmailMultiAlternatives(EmailMessage):
@@ -335,6 +861,10 @@ class EmailMultiAlternatives(EmailMessage):
         assert mimetype is not None
         self.alternatives.append((content, mimetype))
 
+    def message_chunks(self):
+        # parts with alternatives are not cached
+        return [as_bytes(self.message(), linesep='\r\n')]
+
     def _create_message(self, msg):
         return self._create_attachments(self._create_alternatives(msg))
 
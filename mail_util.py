@@ -1,13 +1,25 @@
+import csv
+import html
+import io
 import json
+import logging
 import os
 from argparse import ArgumentError
-from datetime import datetime
+from itertools import repeat
 from shutil import copyfile
 from tempfile import mkstemp
 
-from excel import open_sheet_keep_row
+from journal import journal_key
 from mail_send import EmailMessage
-import markdown2
+from metrics import metrics
+from sheet_table import HeaderIndex
+from template import MailTemplate
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# xlsx: sheet with header and row (keeps formatting), csv: header and row as text,
+# html: table with header and row added to the message body (no attachment)
+ATTACHMENT_FORMATS = ['xlsx', 'csv', 'html']
+
 
 def symbols_replace(template, symbols):
     o = template
@@ -23,32 +35,182 @@ def letter_num(char):
 def format_google_url(url):
     return(url.split('edit')[0]+'edit')
 
-def prepare_mails(data, config, credentials, file_path=None):
-    mails = []
+def prepare_mails(data, config, credentials, file_path=None, skip=None, headers=None, rows=None):
+    return list(iter_mails(data, config, credentials, file_path, skip, headers, rows))
+
+
+def iter_mails(data, config, credentials, file_path=None, skip=None, headers=None, rows=None):
+    """
+    Generator version of prepare_mails: each mail (and its attachment) is only built when requested.
+    :param skip: optional container of journal keys (e.g. SendJournal) for rows that must not be sent again
+    :param headers: header columns (see gsheet.get_header_columns) or HeaderIndex, used by {<header name>} placeholders
+    :param rows: optional indexes of data rows to send (default: all)
+    """
+    columns = headers if isinstance(headers, HeaderIndex) else HeaderIndex(headers or {})
+    headers = columns.columns
+    subject = MailTemplate(config["email"]["subject"], columns, markdown=False)
+    message = MailTemplate(config["email"]["msg"], columns)
 
-    dir_path = ''
-    if file_path is not None:
-        now = datetime.now()
-        dir_path = 'temp{:04d}-{:02d}-{:02d}'.format(now.year, now.month, now.day)
-        if not os.path.exists(dir_path):
-            os.mkdir(dir_path)
+    # checked by validation.validate_settings
+    attachment_format = config["email"].get("attachment-format", "xlsx")
+    header = None
+    if headers:
+        header = [headers.get(c, '') for c in range(max(headers) + 1)]
 
-    for l in range(0, len(data)):
+    # attachments are only written to disk (for auditing) when a directory is configured
+    save_dir = config.get("save-attachments")
+    if file_path is not None and save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+
+    sheet = '{}!{}'.format(config["sheet"]["url"], config["sheet"]["name"])
+    # (data row indexes, mail to, journal key) of every mail
+    selected = []
+    for indexes in group_rows(data, config, rows):
+        l = indexes[0]
         mail_to = data[l][config["sheet"]["email-col"] - 1]
-        mail_attach = None
+        if len(indexes) == 1:
+            key = journal_key(sheet, l, mail_to, [data[l], config["email"]["subject"], config["email"]["msg"]])
+        else:
+            key = journal_key(sheet, l, mail_to, [[data[i] for i in indexes], config["email"]["subject"], config["email"]["msg"]])
+        if skip is not None and key in skip:
+            logging.info('Skipping {}, already sent'.format(mail_to))
+            continue
+        selected.append((indexes, mail_to, key))
+
+    attachments = repeat((None, None))
+    # file names depend only on row, so output is the same with any number of workers
+    names = ['{}-{}.{}'.format(mail_to[:mail_to.find('@')], indexes[0], attachment_format) for indexes, mail_to, _ in selected]
+
+    if file_path is not None and attachment_format == 'xlsx':
+        # openpyxl is only loaded when xlsx attachments are built
+        from excel import keep_rows_generator, keep_rows_parallel
+
+        targets = [(indexes, os.path.join(save_dir, name) if save_dir else None) for (indexes, _, _), name in zip(selected, names)]
+        starts_at = config["sheet"]["header-rows"] + config["sheet"]["start-row"]
+        workers = config.get("workers", 1)
+        compression = config["email"].get("attachment-compression", 9)
+
+        if workers > 1:
+            attachments = keep_rows_parallel(file_path, config["sheet"]["name"], starts_at, targets, workers, compression)
+        else:
+            attachments = keep_rows_generator(file_path, config["sheet"]["name"], starts_at, targets, compression)
 
-        if file_path is not None:
-            now = datetime.now()
-            starting_name = mail_to[:mail_to.find('@')] + '-{}-{}'.format(now.second, now.microsecond)
-            mail_attach = os.path.join(dir_path, starting_name + '.xlsx')
-            open_sheet_keep_row(file_path, mail_attach, config["sheet"]["name"], config["sheet"]["header-rows"] + config["sheet"]["start-row"], l)
+    digest = config["email"].get("cc-digest", False) and cc_list(config)
+    digest_rows = []
+    digest_keys = []  # of the mails built, mails whose attachment failed are left out
 
-        mail = prepare_mail(config["email"]["subject"], config["email"]["msg"], credentials['username'], mail_to, mail_attach)
-        mails.append(mail)
-    return mails
+    attachments = iter(attachments)
+    for (indexes, mail_to, key), name in zip(selected, names):
+        with metrics.timer('attachment'):
+            content, error = next(attachments)
+        if error is not None:
+            logging.error('Could not prepare attachment for {}: {}'.format(mail_to, error))
+            metrics.count('error.attachment')
+            continue
+
+        with metrics.timer('mail_build'):
+            mail_rows = [data[i] for i in indexes]
+            # grouped rows usually render the same message, which is then written only once
+            body = '\n<hr>\n'.join(dict.fromkeys(message.render(row) for row in mail_rows))
+            attachment = None
+            if content is not None:
+                attachment = (name, content, XLSX_MIMETYPE)
+            elif attachment_format == 'csv':
+                attachment = (name, rows_csv(header, mail_rows), 'text/csv')
+            elif attachment_format == 'html':
+                body += rows_html_table(header, mail_rows)
+            mail = build_mail(subject.render(mail_rows[0]), body, credentials['username'], mail_to, attachment)
+        mail.journal_key = key
+        mail.rows = indexes
+        if digest:
+            digest_rows.extend(mail_rows)
+            digest_keys.append(key)
+        yield mail
+
+    if digest and digest_rows:
+        mail = build_digest(header, digest_rows, len(digest_keys), credentials['username'], digest)
+        mail.journal_key = journal_key(sheet, 'digest', ';'.join(digest), digest_keys)
+        yield mail
+
+
+def group_rows(data, config, rows=None):
+    """
+    Data row indexes sent together. With group-by-recipient (email section of config), rows with the
+    same recipient are sent in one mail and identical rows are sent only once.
+    :param rows: optional indexes of data rows to send (default: all)
+    :return: list of lists of row indexes, in sheet order
+    """
+    if rows is None:
+        rows = range(0, len(data))
+    if not config["email"].get("group-by-recipient", False):
+        return [[l] for l in rows]
+
+    email_col = config["sheet"]["email-col"] - 1
+    groups = {}  # recipient => {row values: row index}
+    for l in rows:
+        recipient = data[l][email_col].strip().lower()
+        groups.setdefault(recipient, {}).setdefault(tuple(data[l]), l)
+
+    merged = sum(len(g) for g in groups.values()) - len(groups)
+    if merged:
+        metrics.count('rows_merged', merged)
+    return [list(g.values()) for g in groups.values()]
+
+
+def cc_list(config):
+    """
+    :return: addresses in cc of email section of config (separated by ;)
+    """
+    return [x.strip() for x in (config["email"].get("cc") or '').split(';') if x.strip()]
+
+
+def build_digest(header, rows, mails, username, cc):
+    """
+    Single mail sent to cc recipients instead of a copy of every mail. It is built before the
+    mails are delivered, so it lists the mails being sent, not their delivery.
+    :param header: column names (or None)
+    :param rows: rows of every mail
+    :param mails: number of mails
+    :param cc: list of recipients
+    """
+    body = '<p>{} mails with {} rows are being sent to their recipients. Rows are attached.</p>'.format(mails, len(rows))
+    return build_mail('Summary: {} mails'.format(mails), body, username, ';'.join(cc),
+                      ('digest.csv', rows_csv(header, rows), 'text/csv'))
+
+
+def rows_csv(header, rows):
+    """
+    :param header: column names (or None)
+    :param rows: list of row values
+    :return: CSV text with header and rows. Starts with a BOM so Excel reads it as UTF-8.
+    """
+    out = io.StringIO()
+    out.write('\ufeff')
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def rows_html_table(header, rows):
+    """
+    :param header: column names (or None)
+    :param rows: list of row values
+    :return: HTML table with header and rows
+    """
+    lines = ['<table border="1" cellspacing="0" cellpadding="4">']
+    if header:
+        lines.append('<tr>' + ''.join('<th>{}</th>'.format(html.escape(str(v))) for v in header) + '</tr>')
+    for row in rows:
+        lines.append('<tr>' + ''.join('<td>{}</td>'.format(html.escape(str(v))) for v in row) + '</tr>')
+    lines.append('</table>')
+    return '\n'.join(lines)
 
 
 def prepare_mail(mail_subject, mail_msg, mail_username, mail_to, mail_attach=None):
+    import markdown2
+
     data = ''
     symbols = {}
     symbols['{data}'] = data
@@ -56,12 +218,23 @@ def prepare_mail(mail_subject, mail_msg, mail_username, mail_to, mail_attach=Non
     subject = symbols_replace(mail_subject, symbols)
     username = symbols_replace(mail_username, symbols)
     message = symbols_replace(markdown2.markdown(mail_msg), symbols)
-    to = symbols_replace(mail_to, symbols).split(';')
-    to = [x.strip() for x in to]
+    to = symbols_replace(mail_to, symbols)
+    mail = build_mail(subject, message, username, to)
+    if mail_attach is not None:
+        mail.attach_file(mail_attach, XLSX_MIMETYPE)
+    return mail
+
+
+def build_mail(subject, message, username, mail_to, attachment=None):
+    """
+    Creates the mail from an already rendered subject and (HTML) message.
+    :param attachment: optional (filename, content, mimetype)
+    """
+    to = [x.strip() for x in mail_to.split(';')]
     mail = EmailMessage(subject, message, username, to)
     mail.content_subtype = "html"
-    if mail_attach is not None:
-        mail.attach_file(mail_attach, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    if attachment is not None:
+        mail.attach(*attachment)
     return mail
 
 
@@ -83,7 +256,4 @@ def load_mail_credentials(path):
 
 
 def find_mail_column_index(headers, mail_column):
-    for k, v in headers.items():
-        if v == mail_column:
-            return k
-    return None
+    return HeaderIndex(headers).resolve(mail_column)
@@ -1,22 +1,46 @@
 # Author: Eduardo Marossi
 # Version: 1.1.0
 import argparse
+import copy
 import logging
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from tempfile import mkstemp
 
-import excel
-from gsheet import read_sheet, get_header_lines_number, get_header_columns, sheet_id_from_url
-from mail_util import load_mail_credentials, find_mail_column_index, prepare_mails, format_google_url
-from mail_send import email_providers, EmailBackend
+from journal import SendJournal
+from metrics import metrics
+from sheet_cache import SheetCache
+from sheet_table import SheetTable
+from shard import Shard, ShardStore
+from validation import resolve_email_column, validate_rows, validate_settings, ValidationError
+from gsheet import get_client, get_header_lines_number, sheet_id_from_url
+from mail_util import load_mail_credentials, find_mail_column_index, prepare_mails, iter_mails, format_google_url, cc_list, ATTACHMENT_FORMATS
+from mail_send import email_providers, provider_limits, PooledEmailBackend, RateLimiter
 import yaml
 
 APP_VERSION = '1.1.0'
 
-if __name__ == '__main__':
-    argparse.ArgumentParser()
+
+def adjust_mails(mails, args, config):
+    # applied one mail at a time, so mails can still be sent while others are prepared
+    cc = cc_list(config)
+    for m in mails:
+        if args.debug_force_to is not None:
+            # test mails only go to the forced address, never to the cc list
+            m.to = [args.debug_force_to]
+            m.cc = []
+        elif not config["email"].get("cc-digest", False):
+            # with cc-digest, cc recipients get a single summary mail instead (see iter_mails)
+            m.cc.extend(cc)
+        yield m
+
+
+def build_parser():
     parser = argparse.ArgumentParser(prog='mailsheet {}'.format(APP_VERSION),
                                      description='Sends email for every row in a Excel or Google Sheet')
+    parser.add_argument('command', nargs='?', default='send', choices=['send', 'serve'], help='send (default) runs config once. serve waits for jobs.')
     parser.add_argument('--config', default=None,  type=str, help='Config file')
     parser.add_argument('--dry-run', default=False, action='store_true', help='Do not send mail. Show results')
     parser.add_argument('-d', '--debug', default=False, action='store_true', help='Enable debug. Default: off')
@@ -25,71 +49,426 @@ if __name__ == '__main__':
     parser.add_argument('--debug-send-interval-start', default=None, type=int, help='Start sending mail after start interval')
     parser.add_argument('--debug-send-interval-end', default=None, type=int, help='End sending mail after end interval.')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Verbose output. Default: off')
+    parser.add_argument('--workers', default=None, type=int, help='Number of processes used to generate attachments. Default: config workers or 1')
+    parser.add_argument('--connections', default=None, type=int, help='Number of SMTP connections used to send. Default: config email connections or 1')
+    parser.add_argument('--engine', default=None, choices=['threads', 'async'], help='Sending engine: one thread per connection, or asyncio with SMTP pipelining. Default: config email engine or threads')
+    parser.add_argument('--journal', default='mailsheet-journal.db', type=str, help='File where delivered mails are recorded. Default: mailsheet-journal.db')
+    parser.add_argument('--resume', default=False, action='store_true', help='Skip rows already delivered according to journal.')
+    parser.add_argument('--cache', default='mailsheet-cache.db', type=str, help='File where fetched Google Sheets are cached. Default: mailsheet-cache.db')
+    parser.add_argument('--changed-only', default=False, action='store_true', help='Only send rows that changed since last run.')
+    parser.add_argument('--metrics-log', default=None, type=str, help='Writes timing and counter events as JSON lines to file.')
+    parser.add_argument('--prometheus', default=None, type=str, help='Writes run metrics in Prometheus text format to file.')
+    parser.add_argument('--save-attachments', default=None, type=str, help='Also saves generated attachments to directory (for auditing).')
+    parser.add_argument('--attachment-format', default=None, choices=ATTACHMENT_FORMATS, help='Row data sent as xlsx or csv attachment, or as html table in message. Default: config email attachment-format or xlsx')
+    parser.add_argument('--group-by-recipient', default=False, action='store_true', help='One mail per recipient with all of its rows. Default: config email group-by-recipient or off')
+    parser.add_argument('--cc-digest', default=False, action='store_true', help='cc recipients get one summary mail instead of a copy of every mail. Default: config email cc-digest or off')
+    parser.add_argument('--strict', default=False, action='store_true', help='Send nothing if any row or setting is invalid. Default: invalid rows are skipped')
+    parser.add_argument('--shards', default=1, type=int, help='Splits rows by recipient in this number of shards, each sent with a profile of --profiles. Default: 1 (no sharding)')
+    parser.add_argument('--shard', default=None, type=int, nargs='+', help='Shards (1 to --shards) sent by this process, others are left to other hosts. Default: all, each in its own process')
+    parser.add_argument('--profiles', default=None, type=str, nargs='+', help='Mail credentials files used by shards, shard n uses profile n (cycling). Default: mail_credentials.json')
+    parser.add_argument('--coordination', default='mailsheet-shards.db', type=str, help='File shared by all shards (on a shared disk for several hosts) where mails are claimed. Default: mailsheet-shards.db')
+    parser.add_argument('--port', default=8787, type=int, help='serve: local HTTP port receiving jobs. Default: 8787')
+    parser.add_argument('--watch', default=None, type=str, help='serve: directory watched for job config files (.yml).')
     parser.add_argument('--sends-as-file', default=True, action='store_true', help='Sends resulting sheet with header and row data. Recommended if you want tot preserve formattting.')
-    args = parser.parse_args()
+    return parser
 
-    if args.debug:
-        logging.basicConfig(level=logging.DEBUG)
 
-    mail_credentials_path = 'mail_credentials.json'
-    google_credentials_path = 'google_credentials.json'
+def apply_args(config, args):
+    """
+    Command line options override config file values.
+    """
+    config.setdefault('email', {})
+    if 'google.com' in config.get('sheet', {}).get('url', ''):
+        config['sheet']['url'] = format_google_url(config['sheet']['url'])
+    if args.workers is not None:
+        config['workers'] = args.workers
+    if args.save_attachments is not None:
+        config['save-attachments'] = args.save_attachments
+    if args.attachment_format is not None:
+        config['email']['attachment-format'] = args.attachment_format
+    if args.connections is not None:
+        config['email']['connections'] = args.connections
+    if args.engine is not None:
+        config['email']['engine'] = args.engine
+    if args.add_cc:
+        config['email']['cc'] = ';'.join(cc_list(config) + args.add_cc)
+    if args.group_by_recipient:
+        config['email']['group-by-recipient'] = True
+    if args.cc_digest:
+        config['email']['cc-digest'] = True
+    return config
 
-    if args.config:
-        config_file = args.config
-    else:
-        config_file = 'config.yml'
 
-    with open(config_file, 'r') as file:
-        config = yaml.load(file, Loader=yaml.FullLoader)
-    config['sheet']['url'] = format_google_url(config['sheet']['url'])
+def send_limits(config, mail_credentials):
+    limits = dict(provider_limits.get(mail_credentials['provider'], {}))
+    limits.update(config['email'].get('rate-limit') or {})
+    return limits
 
-    mail_credentials = load_mail_credentials(mail_credentials_path)
 
-    file_path = None
-    if 'google.com' in config["sheet"]["url"]:
-        if args.sends_as_file:
-            handle, file_path = mkstemp(suffix='.xlsx')
-            os.close(handle)
-        data = read_sheet(google_credentials_path, config["sheet"]["url"], '{}!{}'.format(config["sheet"]["name"], config["sheet"]["range"]), file_path)
-        print('Google Docs temp file: {}'.format(file_path))
-    else:
-        file_path = config["sheet"]["url"]
-        data = excel.read_sheet(config["sheet"]["url"], config["sheet"]["name"], config["sheet"]["range"])
+def make_sender(config, mail_credentials, journal, keep_alive=False, sharing=1):
+    """
+    :param sharing: senders using the account at the same time (shards of one profile), its per-minute limit is split among them
+    """
+    limits = send_limits(config, mail_credentials)
+    per_minute = limits.get('per-minute')
+    if per_minute and sharing > 1:
+        per_minute = max(1, per_minute // sharing)
+    server = dict(email_providers.get(mail_credentials['provider'], {}))
+    # a profile may set its own server (example: a local SMTP server for tests)
+    server.update({k: mail_credentials[k] for k in ('host', 'port', 'use_ssl', 'use_tls') if k in mail_credentials})
 
-    if args.sends_as_file:
-        mails = prepare_mails(data[config["sheet"]["header-rows"]:], config, mail_credentials, file_path)
-    else:
-        mails = prepare_mails(data[config["sheet"]["start-row"]:], mail_index, config["email"]['subject'], mail_credentials['message'], mail_credentials['username'])
+    backend_class = PooledEmailBackend
+    if config['email'].get('engine', 'threads') == 'async':
+        if server.get('use_tls') and not server.get('use_ssl') and sys.version_info < (3, 11):
+            # STARTTLS on asyncio streams (StreamWriter.start_tls) needs Python 3.11
+            print('Warning: engine async needs Python 3.11 for STARTTLS ({}:{}), sending with threads'.format(
+                server.get('host'), server.get('port')))
+        else:
+            from mail_async import AsyncEmailBackend
+            backend_class = AsyncEmailBackend
 
-    sender = EmailBackend(username=mail_credentials['username'], password=mail_credentials['app_password'], **email_providers[mail_credentials['provider']])
+    return backend_class(username=mail_credentials['username'], password=mail_credentials['app_password'],
+                              journal=journal,
+                              connections=config['email'].get('connections', 1),
+                              max_messages_per_connection=config['email'].get('max-per-connection'),
+                              rate_limiter=RateLimiter(per_minute, limits.get('per-day')),
+                              keep_alive=keep_alive,
+                              **server)
 
-    if args.debug_force_to is not None:
-        for m in mails:
-            m.to = [args.debug_force_to]
 
-    for m in mails:
-        if len(m.cc) > 0:
-            m.cc.extend([x.strip() for x in config["email"]["cc"].split(';')])
+def job_configs(config):
+    """
+    Every job of a batch config: each item of jobs overrides the sheet and email sections (and any
+    other key) of the top level config. A config without jobs has a single job.
+    :return: list of job configs
+    """
+    if not config.get('jobs'):
+        return [config]
+
+    defaults = {k: v for k, v in config.items() if k != 'jobs'}
+    configs = []
+    for job in config['jobs']:
+        merged = copy.deepcopy(defaults)
+        for k, v in job.items():
+            if isinstance(v, dict) and isinstance(merged.get(k), dict):
+                merged[k].update(v)
+            else:
+                merged[k] = v
+        configs.append(merged)
+    return configs
+
+
+def sheet_key(config):
+    return config["sheet"]["url"], config["sheet"]["name"], config["sheet"]["range"]
+
+
+def fetch_sheets(configs, args, cache):
+    """
+    Reads the data of every job once. All ranges of a Google spreadsheet are fetched with a single
+    request, and it is exported (once) only if some job sends xlsx attachments.
+    :return: dict (url, sheet name, range) => SheetTable, and dict Google url => exported xlsx (temporary file)
+    """
+    data = {}
+    exports = {}
+    google = {}  # url => [(url, sheet name, range)]
+    for config in configs:
+        key = sheet_key(config)
+        url = config["sheet"]["url"]
+        if 'google.com' in url:
+            if key not in google.setdefault(url, []):
+                google[url].append(key)
+            # only xlsx attachments need the whole spreadsheet
+            if args.sends_as_file and config['email'].get('attachment-format', 'xlsx') == 'xlsx' and url not in exports:
+                handle, exports[url] = mkstemp(suffix='.xlsx')
+                os.close(handle)
+                print('Google Docs temp file: {}'.format(exports[url]))
+        elif key not in data:
+            import excel
+
+            with metrics.timer('sheet_fetch'):
+                data[key] = excel.read_table(*key)
+
+    for url, keys in google.items():
+        ranges = ['{}!{}'.format(name, sheet_range) for _, name, sheet_range in keys]
+        with metrics.timer('sheet_fetch'):
+            values = get_client(google_credentials_path).read_ranges(url, ranges, exports.get(url), cache)
+        data.update((key, SheetTable.from_rows(v)) for key, v in zip(keys, values))
+    return data, exports
+
+
+def run_batch(configs, args, mail_credentials, sender, journal=None, shard=None):
+    """
+    Runs every job config through the same sender, reading each sheet only once.
+    :param shard: only rows of this Shard are sent (default: all rows)
+    :return: number of mails sent (or shown)
+    """
+    cache = SheetCache(args.cache)
+    exports = {}
+    count = 0
+    try:
+        sheets, exports = fetch_sheets(configs, args, cache)
+
+        # every job is checked before the first mail is sent, so all problems are reported together
+        checked = []
+        invalid = 0
+        failed = 0
+        for config in configs:
+            if len(configs) > 1:
+                print('Checking job {}: {}'.format(config["sheet"]["name"], config["email"]["subject"]))
+            try:
+                headers, rows, errors = validate_job(config, args, sheets[sheet_key(config)])
+            except ValidationError as e:
+                print('Error: {}'.format(e))
+                failed += 1
+                continue
+            checked.append((headers, rows))
+            invalid += errors
+        if failed or (invalid and args.strict):
+            raise ValidationError('{} invalid rows or settings, nothing was sent'.format(invalid + failed))
+
+        for config, (headers, rows) in zip(configs, checked):
+            if len(configs) > 1:
+                print('Job {}: {}'.format(config["sheet"]["name"], config["email"]["subject"]))
+            file_path = config["sheet"]["url"]
+            if 'google.com' in file_path:
+                file_path = exports.get(file_path)
+            count += run_job(config, args, mail_credentials, sender, journal, cache, sheets[sheet_key(config)], file_path,
+                             headers, rows, shard)
+    finally:
+        cache.close()
+        for file_path in exports.values():
+            os.unlink(file_path)
+    return count
+
+
+def validate_job(config, args, data):
+    """
+    Checks the settings and every row of a job, printing the problems found.
+    :param data: sheet values (SheetTable)
+    :return: HeaderIndex (None without header rows), indexes of valid data rows (None: all rows), number of errors
+    :raises ValidationError: invalid setting
+    """
+    if not args.sends_as_file:
+        return None, None, 0
+
+    validate_settings(config)
+    headers = None
+    if config["sheet"]["header-rows"] > 0:
+        with metrics.timer('header_parse'):
+            headers = data.header(config["sheet"]["header-rows"])
+    resolve_email_column(config, headers)
+    with metrics.timer('validate'):
+        rows, errors, warnings = validate_rows(data[config["sheet"]["header-rows"]:], config, headers, args.strict)
+    for warning in warnings:
+        print('Warning: {}'.format(warning))
+    for error in errors:
+        print('Error: {}'.format(error))
+    if errors:
+        metrics.count('error.validation', len(errors))
+        if not args.strict:
+            print('{} rows rejected'.format(len(data) - config["sheet"]["header-rows"] - len(rows)))
+    return headers, rows, len(errors)
 
-    if args.debug_send_interval_start is not None and args.debug_send_interval_end is not None:
-        mails = mails[args.debug_send_interval_start:args.debug_send_interval_end]
-    elif args.debug_send_interval_start is not None:
-        mails = mails[args.debug_send_interval_start:]
-    elif args.debug_send_interval_end is not None:
-        mails = mails[:args.debug_send_interval_end]
+
+def run_job(config, args, mail_credentials, sender, journal, cache, data, file_path, headers, rows, shard=None):
+    """
+    Sends (or shows, on dry run) a mail for every row of the sheet in config.
+    :param data: sheet values (SheetTable)
+    :param file_path: xlsx file with the sheet (used by xlsx attachments)
+    :param headers: HeaderIndex of the sheet header (see validate_job)
+    :param rows: indexes of valid data rows (see validate_job)
+    :param shard: only rows of this Shard are sent (default: all rows)
+    :return: number of mails sent (or shown)
+    """
+    if args.sends_as_file:
+        if args.changed_only:
+            changed = cache.changed_rows('{}!{}'.format(config["sheet"]["url"], config["sheet"]["name"]), config["sheet"]["range"], data[config["sheet"]["header-rows"]:])
+            print('{} rows changed since last run'.format(len(changed)))
+            changed = set(changed)
+            rows = [l for l in rows if l in changed]
+
+        skip = journal if args.resume else None
+        if shard is not None:
+            # mails of a recipient always go to the same shard, so they can be grouped
+            email_col = config["sheet"]["email-col"] - 1
+            body = data[config["sheet"]["header-rows"]:]
+            rows = [l for l in rows if shard.owns(str(body[l][email_col]))]
+            print('Shard {}: {} rows'.format(shard, len(rows)))
+            # sent mails are never claimed again, skipped before building their attachments
+            skip = shard
+        mails = iter_mails(data[config["sheet"]["header-rows"]:], config, mail_credentials, file_path,
+                           skip=skip, headers=headers, rows=rows)
+    else:
+        mails = prepare_mails(data[config["sheet"]["start-row"]:], mail_index, config["email"]['subject'], mail_credentials['message'], mail_credentials['username'])
+
+    mails = adjust_mails(mails, args, config)
+    mails = islice(mails, args.debug_send_interval_start, args.debug_send_interval_end)
 
     if args.dry_run:
-        print('Results in {} mails:'.format(len(mails)))
+        count = 0
         for mail in mails:
             print(mail)
             print(' ')
+            count += 1
+        print('Results in {} mails'.format(count))
     else:
+        if shard is not None:
+            mails = shard.claim_mails(mails)
+        mail_rows = []  # data rows of every mail, in send order (SendResult index)
+        mails = track_rows(mails, mail_rows)
         print('Sending mails...')
-        print('Sent {} mails'.format(sender.send_messages(mails)))
+        count = sender.send_messages(mails)
+        print('Sent {} mails'.format(count))
+        for result in sender.results:
+            if not result.sent:
+                print('Failed to send mail to {}: {}'.format(result.to, result.error))
+        if shard is not None:
+            shard.release_failed(sender.results)
+        # forced recipients are for debugging, their rows are still to be sent
+        if args.debug_force_to is None:
+            delivered = [l for result in sender.results if result.sent for l in mail_rows[result.index] or []]
+            cache.mark_rows_seen('{}!{}'.format(config["sheet"]["url"], config["sheet"]["name"]), config["sheet"]["range"],
+                                 data[config["sheet"]["header-rows"]:], delivered)
+    return count
+
+
+def track_rows(mails, mail_rows):
+    for mail in mails:
+        mail_rows.append(mail.rows)
+        yield mail
+
+
+def run_shard(index, args, sender_config, configs, worker=False):
+    """
+    Sends the rows of one shard with its credential profile.
+    :param index: shard index, 0 to args.shards - 1
+    :param worker: run on a worker process, its metrics are returned to the parent
+    :return: number of mails sent (or shown), and metrics state on a worker
+    """
+    if worker:
+        metrics.reset()
+        if args.metrics_log:
+            # one event log per shard
+            name, ext = os.path.splitext(args.metrics_log)
+            metrics.log = None
+            metrics.open_log('{}-{}{}'.format(name, index + 1, ext))
+
+    profiles = args.profiles or [mail_credentials_path]
+    profile = profiles[index % len(profiles)]
+    mail_credentials = load_mail_credentials(profile)
+    # the daily quota is shared through the store, the per-minute limit is split among the shards of the profile
+    sharing = sum(1 for i in range(args.shards) if profiles[i % len(profiles)] == profile)
+    store = None
+    if not args.dry_run and args.debug_force_to is None:
+        store = ShardStore(args.coordination)
+    shard = Shard(store, index, args.shards, mail_credentials['username'],
+                  send_limits(sender_config, mail_credentials).get('per-day'))
+    sender = make_sender(sender_config, mail_credentials, shard, keep_alive=len(configs) > 1, sharing=sharing)
+    try:
+        count = run_batch(configs, args, mail_credentials, sender, shard, shard)
+    finally:
+        sender.close()
+        shard.close()
+    if not worker:
+        return count
+    metrics.close()
+    return count, metrics.state()
+
+
+def run_shards(args, sender_config, configs):
+    """
+    Sends the shards selected by --shard (default: all), each in its own process.
+    :return: number of mails sent (or shown)
+    """
+    indexes = [i - 1 for i in args.shard] if args.shard else list(range(args.shards))
+    if len(indexes) == 1:
+        return run_shard(indexes[0], args, sender_config, configs)
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=len(indexes)) as executor:
+        futures = [executor.submit(run_shard, i, args, sender_config, configs, True) for i in indexes]
+        for future in futures:
+            shard_count, state = future.result()
+            count += shard_count
+            metrics.merge(state)
+    return count
+
+
+mail_credentials_path = 'mail_credentials.json'
+google_credentials_path = 'google_credentials.json'
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.config:
+        config_file = args.config
+    else:
+        config_file = 'config.yml'
+
+    if args.shard and any(not 1 <= i <= args.shards for i in args.shard):
+        build_parser().error('--shard must be between 1 and --shards ({})'.format(args.shards))
+
+    with open(config_file, 'r') as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    # connections and rate limits of the sender come from the top level email section
+    sender_config = apply_args(copy.deepcopy(config), args)
+    configs = [apply_args(c, args) for c in job_configs(config)]
+
+    sharded = args.shards > 1 and args.command == 'send'
+    # shards load their own profile
+    mail_credentials = None if sharded else load_mail_credentials(mail_credentials_path)
+    if args.metrics_log:
+        metrics.open_log(args.metrics_log)
+
+    # forced recipients are for debugging, so they are never recorded as delivered
+    # (shards record them in the coordination store instead)
+    journal = None
+    if not args.dry_run and args.debug_force_to is None and not sharded:
+        journal = SendJournal(args.journal)
 
-    if 'google.com' in config["sheet"]["url"] and args.sends_as_file:
-        os.unlink(file_path)
+    exit_code = 0
+    try:
+        if args.command == 'serve':
+            from server import serve
 
+            # one warm sender (connections and rate limits of config file) shared by every job
+            sender = make_sender(sender_config, mail_credentials, journal, keep_alive=True)
 
+            def run(job_config):
+                return run_batch([apply_args(c, args) for c in job_configs(job_config)], args, mail_credentials, sender, journal)
 
+            try:
+                serve(run, args.port, args.watch)
+            finally:
+                sender.close()
+        elif sharded:
+            try:
+                run_shards(args, sender_config, configs)
+            except ValidationError as e:
+                print(e)
+                exit_code = 1
+        else:
+            # batch jobs share warm connections
+            sender = make_sender(sender_config, mail_credentials, journal, keep_alive=len(configs) > 1)
+            try:
+                run_batch(configs, args, mail_credentials, sender, journal)
+            except ValidationError as e:
+                print(e)
+                exit_code = 1
+            finally:
+                sender.close()
+    finally:
+        # mails delivered before an interruption (Ctrl-C) or error are kept for --resume
+        if journal is not None:
+            journal.close()
 
+    print(metrics.summary())
+    if args.prometheus:
+        with open(args.prometheus, 'w') as f:
+            f.write(metrics.prometheus())
+    metrics.close()
+    sys.exit(exit_code)
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Stage timings and counters for a run. Cheap enough to be always on: each event is a
+    perf_counter pair and a dict update, plus one JSON line when a log file is open.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.timings = {}  # stage => [count, total seconds, max seconds]
+        self.counters = {}
+        self.log = None
+
+    def open_log(self, path):
+        """
+        Writes every event as a JSON line to path (appending).
+        """
+        self.log = open(path, 'a', buffering=64 * 1024)
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **fields)
+
+    def observe(self, stage, seconds, **fields):
+        with self.lock:
+            t = self.timings.get(stage)
+            if t is None:
+                self.timings[stage] = [1, seconds, seconds]
+            else:
+                t[0] += 1
+                t[1] += seconds
+                if seconds > t[2]:
+                    t[2] = seconds
+            if self.log is not None:
+                fields.update(time=time.time(), stage=stage, seconds=seconds)
+                self.log.write(json.dumps(fields, default=str) + '\n')
+
+    def count(self, name, value=1, **fields):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if self.log is not None:
+                fields.update(time=time.time(), counter=name, value=value)
+                self.log.write(json.dumps(fields, default=str) + '\n')
+
+    def state(self):
+        """
+        :return: timings and counters, to be merged (see merge) into the metrics of another process
+        """
+        with self.lock:
+            return {k: list(v) for k, v in self.timings.items()}, dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    def merge(self, state):
+        timings, counters = state
+        with self.lock:
+            for stage, (count, total, longest) in timings.items():
+                t = self.timings.setdefault(stage, [0, 0.0, 0.0])
+                t[0] += count
+                t[1] += total
+                t[2] = max(t[2], longest)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        :return: text report with every stage and counter
+        """
+        elapsed = time.time() - self.started
+        lines = ['Run metrics ({:.1f}s):'.format(elapsed)]
+        with self.lock:
+            for stage, (count, total, longest) in self.timings.items():
+                lines.append('  {:<16} {:>8} x  total {:>9.3f}s  avg {:>8.2f}ms  max {:>8.2f}ms'.format(
+                    stage, count, total, total / count * 1000, longest * 1000))
+            for name, value in sorted(self.counters.items()):
+                lines.append('  {:<16} {:>8}'.format(name, value))
+            sent = self.counters.get('sent', 0)
+        if sent and elapsed > 0:
+            lines.append('  {:.2f} messages/s'.format(sent / elapsed))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """
+        :return: metrics in Prometheus text exposition format
+        """
+        lines = ['# TYPE mailsheet_stage_seconds summary']
+        with self.lock:
+            for stage, (count, total, _) in self.timings.items():
+                lines.append('mailsheet_stage_seconds_sum{{stage="{}"}} {}'.format(stage, total))
+                lines.append('mailsheet_stage_seconds_count{{stage="{}"}} {}'.format(stage, count))
+            lines.append('# TYPE mailsheet_events_total counter')
+            for name, value in sorted(self.counters.items()):
+                lines.append('mailsheet_events_total{{name="{}"}} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+
+# shared by every module of a run
+metrics = Metrics()
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+from metrics import metrics
+
+
+class JobQueue:
+    """
+    Jobs (same format as config.yml) run one after another on a single thread, all through the
+    same warm sender, so the provider limits are respected for every job.
+    """
+    def __init__(self, run_job):
+        """
+        :param run_job: function receiving a job config and returning the number of mails sent
+        """
+        self.run_job = run_job
+        self.jobs = {}  # job id => status
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, config, source):
+        if not isinstance(config, dict) or not (config.get('jobs') or ('sheet' in config and 'email' in config)):
+            raise ValueError('Job must have sheet and email sections (or a jobs list)')
+
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.jobs[job_id] = {'id': job_id, 'status': 'queued', 'source': source, 'submitted': time.time()}
+        self.pending.put((job_id, config))
+        logging.info('Job {} queued from {}'.format(job_id, source))
+        return job_id
+
+    def status(self, job_id=None):
+        with self.lock:
+            if job_id is None:
+                return [dict(j) for j in self.jobs.values()]
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def _run(self):
+        while True:
+            job_id, config = self.pending.get()
+            self._update(job_id, status='running', started=time.time())
+            try:
+                sent = self.run_job(config)
+                self._update(job_id, status='done', sent=sent, finished=time.time())
+            except Exception as e:
+                logging.exception('Job {} failed'.format(job_id))
+                self._update(job_id, status='failed', error=repr(e), finished=time.time())
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs (YAML or JSON config) queues a job. GET /jobs, GET /jobs/<id> show status,
+    GET /metrics returns run metrics in Prometheus text format.
+    """
+    def _reply(self, code, body, content_type='application/json'):
+        data = body.encode('utf-8') if isinstance(body, str) else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self._reply(404, {'error': 'not found'})
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            # JSON is also valid YAML
+            job_id = self.server.jobs.submit(yaml.safe_load(body), 'http')
+        except (ValueError, yaml.YAMLError) as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(202, {'id': job_id})
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            return self._reply(200, metrics.prometheus(), 'text/plain; version=0.0.4')
+        if self.path == '/jobs':
+            return self._reply(200, self.server.jobs.status())
+        if self.path.startswith('/jobs/'):
+            status = self.server.jobs.status(self.path[len('/jobs/'):])
+            if status is not None:
+                return self._reply(200, status)
+        self._reply(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        logging.info('%s - %s', self.address_string(), format % args)
+
+
+def watch_directory(path, jobs, interval=2.0):
+    """
+    Queues every .yml/.yaml file that shows up in path, once its size and modification time
+    did not change between two polls (so files still being written are left for later).
+    Files are renamed to .queued (or .invalid) so they are picked only once.
+    """
+    sizes = {}  # file name => (size, mtime) at the last poll
+    while True:
+        try:
+            names = sorted(n for n in os.listdir(path) if n.endswith(('.yml', '.yaml')))
+        except OSError as e:
+            logging.error('Could not list {}: {}'.format(path, e))
+            names = []
+        previous, sizes = sizes, {}
+        for name in names:
+            full_path = os.path.join(path, name)
+            try:
+                stat = os.stat(full_path)
+            except OSError as e:
+                logging.error('Could not read job file {}: {}'.format(full_path, e))
+                continue
+            sizes[name] = (stat.st_size, stat.st_mtime_ns)
+            if previous.get(name) != sizes[name]:
+                continue
+            del sizes[name]
+            _queue_job_file(full_path, jobs)
+        time.sleep(interval)
+
+
+def _queue_job_file(full_path, jobs):
+    # errors are logged, so one bad file does not stop the watcher
+    try:
+        with open(full_path, 'r') as file:
+            config = yaml.safe_load(file)
+        # renamed before queueing, so a file that can not be renamed is never sent twice
+        os.rename(full_path, full_path + '.queued')
+    except yaml.YAMLError as e:
+        logging.error('Invalid job file {}: {}'.format(full_path, e))
+        _rename(full_path, full_path + '.invalid')
+        return
+    except OSError as e:
+        logging.error('Could not read job file {}: {}'.format(full_path, e))
+        return
+    try:
+        jobs.submit(config, full_path)
+    except ValueError as e:
+        logging.error('Invalid job file {}: {}'.format(full_path, e))
+        _rename(full_path + '.queued', full_path + '.invalid')
+
+
+def _rename(source, dest):
+    try:
+        os.rename(source, dest)
+    except OSError as e:
+        logging.error('Could not rename {}: {}'.format(source, e))
+
+
+def serve(run_job, port, watch=None):
+    """
+    Runs until interrupted, accepting jobs from local HTTP and (optionally) a watched directory.
+    :param run_job: function receiving a job config and returning the number of mails sent
+    :param port: HTTP port, bound to localhost only
+    :param watch: directory with job files (optional)
+    """
+    jobs = JobQueue(run_job)
+    if watch is not None:
+        os.makedirs(watch, exist_ok=True)
+        threading.Thread(target=watch_directory, args=(watch, jobs), daemon=True).start()
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), JobRequestHandler)
+    httpd.jobs = jobs
+    print('mailsheet serving on http://127.0.0.1:{}/jobs'.format(port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
@@ -0,0 +1,144 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def shard_of(recipient, shards):
+    """
+    Shard that sends the mails of a recipient: the same on every host and run (unlike hash()).
+    :param recipient: email cell (compared in lower case, like group-by-recipient)
+    :param shards: number of shards
+    :return: shard index, 0 to shards - 1
+    """
+    digest = hashlib.sha1(recipient.strip().lower().encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+
+class ShardStore:
+    """
+    Coordination store shared by every shard of a run, in SQLite: a local file when one host runs
+    all shards, or a file on a shared disk for several hosts. A mail is claimed before it is sent,
+    so it is sent once even by overlapping or repeated runs, and claims of failed mails are released.
+    Claims also count the mails of every credential profile in the last 24 hours, so shards
+    using the same account share its daily quota.
+    Uses the default rollback journal (WAL does not work over network file systems).
+    """
+    def __init__(self, path, timeout=60, stale_after=3600):
+        """
+        :param timeout: seconds to wait while another shard writes
+        :param stale_after: seconds after which an unsent claim of another shard (that stopped) is taken over
+        """
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, shard INTEGER, '
+                                'profile TEXT, claimed_at REAL, sent_at REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS claims_by_profile ON claims (profile, claimed_at)')
+
+    def claim(self, key, shard, profile, per_day=None):
+        """
+        :return: True if shard may send the mail, False if it was sent or is being sent by another
+                 shard, None if profile already used its per_day quota
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute('SELECT shard, claimed_at, sent_at FROM claims WHERE key = ?', (key,)).fetchone()
+                if row is not None and (row[2] is not None or (row[0] != shard and row[1] > now - self.stale_after)):
+                    return False
+                if per_day is not None:
+                    used, = self.connection.execute('SELECT COUNT(*) FROM claims WHERE profile = ? AND claimed_at > ? AND key != ?',
+                                                    (profile, now - 24 * 3600, key)).fetchone()
+                    if used >= per_day:
+                        return None
+                self.connection.execute('INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?, NULL)', (key, shard, profile, now))
+                return True
+            finally:
+                self.connection.execute('COMMIT')
+
+    def mark_sent(self, key):
+        with self.lock:
+            self.connection.execute('UPDATE claims SET sent_at = ? WHERE key = ?', (time.time(), key))
+
+    def release(self, key):
+        with self.lock:
+            self.connection.execute('DELETE FROM claims WHERE key = ? AND sent_at IS NULL', (key,))
+
+    def is_sent(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT sent_at FROM claims WHERE key = ?', (key,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def close(self):
+        self.connection.close()
+
+
+class Shard:
+    """
+    One shard of a sharded run: rows of the recipients it owns, sent with one credential profile.
+    Given to the sender as journal, so delivered mails are recorded in the store.
+    """
+    def __init__(self, store, index, shards, profile, per_day=None):
+        """
+        :param store: ShardStore, or None to only split rows (dry run)
+        :param index: shard index, 0 to shards - 1
+        :param profile: credential profile name (its username), quota is counted by profile
+        :param per_day: daily limit of the profile (None: no limit)
+        """
+        self.store = store
+        self.index = index
+        self.shards = shards
+        self.profile = profile
+        self.per_day = per_day
+        self.claimed = []
+
+    def __str__(self):
+        return '{}/{}'.format(self.index + 1, self.shards)
+
+    def owns(self, recipient):
+        return shard_of(recipient, self.shards) == self.index
+
+    def claim_mails(self, mails):
+        """
+        Yields the mails claimed by this shard, stopping when the profile quota is used up.
+        Keys are kept in send order, see release_failed.
+        """
+        self.claimed = []
+        for mail in mails:
+            if self.store is not None and mail.journal_key is not None:
+                claimed = self.store.claim(mail.journal_key, self.index, self.profile, self.per_day)
+                if claimed is None:
+                    print('Shard {}: daily quota of {} ({} mails) used, remaining mails are left for another run'.format(
+                        self, self.profile, self.per_day))
+                    return
+                if not claimed:
+                    continue
+            self.claimed.append(mail.journal_key)
+            yield mail
+
+    def release_failed(self, results):
+        """
+        Frees the claims of mails that were not sent, so a later run (of any shard) sends them.
+        :param results: sender results (SendResult index is the position in claim_mails order)
+        """
+        for result in results:
+            key = self.claimed[result.index]
+            if not result.sent and self.store is not None and key is not None:
+                self.store.release(key)
+
+    def __contains__(self, key):
+        return self.store is not None and self.store.is_sent(key)
+
+    def record(self, key):
+        if self.store is not None:
+            self.store.mark_sent(key)
+
+    def flush(self):
+        # every change is committed by the store
+        pass
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import sqlite3
+
+
+def row_hash(row):
+    return hashlib.sha1(json.dumps(row, default=str).encode('utf-8')).hexdigest()
+
+
+class SheetCache:
+    """
+    Local copy of the last fetched values (and export file) of Google Sheets, stored in SQLite.
+    Entries are valid while Drive reports the same file version.
+    Also keeps the row hashes seen by the last run, used to find changed rows.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sheet_values '
+                                '(sheet_id TEXT, range TEXT, version TEXT, sheet_values TEXT, PRIMARY KEY (sheet_id, range))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS exports '
+                                '(sheet_id TEXT PRIMARY KEY, version TEXT, content BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS row_hashes '
+                                '(sheet_id TEXT, range TEXT, hashes TEXT, PRIMARY KEY (sheet_id, range))')
+        self.connection.commit()
+
+    def get_values(self, sheet_id, sheet_range, version):
+        row = self.connection.execute('SELECT sheet_values FROM sheet_values WHERE sheet_id = ? AND range = ? AND version = ?',
+                                      (sheet_id, sheet_range, version)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_values(self, sheet_id, sheet_range, version, values):
+        self.connection.execute('INSERT OR REPLACE INTO sheet_values VALUES (?, ?, ?, ?)',
+                                (sheet_id, sheet_range, version, json.dumps(values)))
+        self.connection.commit()
+
+    def get_export(self, sheet_id, version):
+        row = self.connection.execute('SELECT content FROM exports WHERE sheet_id = ? AND version = ?',
+                                      (sheet_id, version)).fetchone()
+        return row[0] if row else None
+
+    def put_export(self, sheet_id, version, content):
+        self.connection.execute('INSERT OR REPLACE INTO exports VALUES (?, ?, ?)', (sheet_id, version, content))
+        self.connection.commit()
+
+    def changed_rows(self, sheet_id, sheet_range, rows):
+        """
+        :param rows: sheet data rows
+        :return: indexes of rows not seen by the last run (all rows if there was no previous run)
+        """
+        row = self.connection.execute('SELECT hashes FROM row_hashes WHERE sheet_id = ? AND range = ?',
+                                      (sheet_id, sheet_range)).fetchone()
+        seen = set(json.loads(row[0])) if row else set()
+        return [i for i, r in enumerate(rows) if row_hash(r) not in seen]
+
+    def mark_rows_seen(self, sheet_id, sheet_range, rows, delivered):
+        """
+        Records the rows delivered by a run. Rows seen by earlier runs stay seen while unchanged, other
+        rows (failed, rejected, or sent by another shard) are left as they were, so they are sent again.
+        :param rows: sheet data rows
+        :param delivered: indexes of rows whose mail was delivered
+        """
+        hashes = [row_hash(r) for r in rows]
+        # read and written in one transaction, shards of a run may share the cache
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.connection.execute('SELECT hashes FROM row_hashes WHERE sheet_id = ? AND range = ?',
+                                          (sheet_id, sheet_range)).fetchone()
+            seen = set(json.loads(row[0])) if row else set()
+            seen = {h for h in hashes if h in seen} | {hashes[i] for i in delivered}
+            self.connection.execute('INSERT OR REPLACE INTO row_hashes VALUES (?, ?, ?)',
+                                    (sheet_id, sheet_range, json.dumps(sorted(seen))))
+
+    def close(self):
+        self.connection.close()
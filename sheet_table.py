@@ -0,0 +1,247 @@
+import difflib
+import re
+import sys
+import unicodedata
+from array import array
+from datetime import date, datetime
+
+# dates are shown (and sent) in this format, see excel.read_sheet
+DATE_FORMAT = '%d/%m/%Y'
+# array type of numeric columns; only the date is shown, so the time of day is not kept
+TYPECODES = {int: 'q', float: 'd', datetime: 'l'}
+
+
+class Column:
+    """
+    Values of one sheet column. Columns mostly made of integers, floats or dates are kept in
+    typed arrays (dates as ordinals), other columns keep interned strings. Cells that do not fit
+    the column type (header, empty or text cells) are kept aside in a dict.
+    """
+    def __init__(self, values):
+        counts = {}
+        for v in values:
+            counts[type(v)] = counts.get(type(v), 0) + 1
+        kind = max(counts, key=counts.get) if counts else str
+
+        self.kind = 'text'
+        self.other = {}
+        if kind in TYPECODES:
+            self.other = {i: _text(v) for i, v in enumerate(values) if type(v) is not kind}
+            try:
+                self.values = array(TYPECODES[kind], (_number(v) if type(v) is kind else 0 for v in values))
+                self.kind = kind.__name__
+            except OverflowError:
+                pass
+        if self.kind == 'text':
+            self.other = {}
+            self.values = [_text(v) for v in values]
+
+    def __getitem__(self, i):
+        if i in self.other:
+            return self.other[i]
+        if self.kind == 'datetime':
+            return date.fromordinal(self.values[i]).strftime(DATE_FORMAT)
+        return self.values[i]
+
+
+def _number(value):
+    return value.toordinal() if isinstance(value, datetime) else value
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        value = value.strftime(DATE_FORMAT)
+    if isinstance(value, str):
+        # repeated values (names of teams, grades, dates) share one string
+        return sys.intern(value)
+    return value
+
+
+class SheetTable:
+    """
+    Sheet values stored by column, a compact replacement for a list of rows.
+    Indexing returns a row as a tuple (with the same values excel/gsheet read_sheet give), and
+    slices are views sharing the same columns (nothing is copied).
+    """
+    def __init__(self, columns, lengths=None, start=0, stop=None):
+        """
+        :param columns: list of Column
+        :param lengths: number of cells of every row, when rows are not all as wide as the table
+        """
+        self.columns = columns
+        self.lengths = lengths
+        self.start = start
+        self.stop = stop if stop is not None else (len(columns[0].values) if columns else 0)
+        self.headers = {}  # header rows => HeaderIndex
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: iterable of row values (e.g. excel.iter_sheet or Google Sheets values), read once
+        """
+        values = []
+        lengths = array('H')
+        count = 0
+        for row in rows:
+            for c in range(len(values), len(row)):
+                # column that only appears now, empty in previous rows
+                values.append([''] * count)
+            for c, v in enumerate(row):
+                values[c].append(v)
+            for c in range(len(row), len(values)):
+                values[c].append('')
+            lengths.append(len(row))
+            count += 1
+
+        ragged = any(n != len(values) for n in lengths)
+        return cls([Column(v) for v in values], lengths if ragged else None)
+
+    def header(self, header_rows):
+        """
+        :param header_rows: number of header rows at the top of the table
+        :return: HeaderIndex of those rows, built once and kept with the table (shared by every job of the sheet)
+        """
+        if header_rows not in self.headers:
+            self.headers[header_rows] = HeaderIndex.from_rows(self[:header_rows])
+        return self.headers[header_rows]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[r] for r in range(start, stop, step)]
+            return SheetTable(self.columns, self.lengths, self.start + start, self.start + max(start, stop))
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('row index out of range')
+        i += self.start
+        width = len(self.columns) if self.lengths is None else self.lengths[i]
+        return tuple(self.columns[c][i] for c in range(width))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def header_key(name):
+    """
+    Header name compared loosely: case, accents, spaces and punctuation are ignored (E-mail, email and E MAIL are the same).
+    """
+    text = unicodedata.normalize('NFKD', str(name)).casefold()
+    return ''.join(ch for ch in text if ch.isalnum())
+
+
+# similarity (see difflib.SequenceMatcher.ratio) of a header name matched by closest spelling
+CLOSE_RATIO = 0.8
+digits_pattern = re.compile(r'\d+')
+
+
+class HeaderIndex:
+    """
+    Header name => column index of a sheet. A name is looked up as written, then loosely (see header_key),
+    then by closest spelling, and every answer is kept, so a name costs one dict lookup after the first.
+    Repeated header names give the first column; the others are also found as "<name> (2)", "<name> (3)"...
+    Used as name => column mapping by MailTemplate.
+    """
+    def __init__(self, columns):
+        """
+        :param columns: dict column index => header name (see gsheet.get_header_columns)
+        """
+        self.columns = columns
+        self.duplicates = {}  # header name => columns
+        self.names = {}
+        for c in sorted(columns):
+            name = columns[c]
+            if name in self.names:
+                self.duplicates.setdefault(name, [self.names[name]]).append(c)
+            else:
+                self.names[name] = c
+        for name, cols in self.duplicates.items():
+            for n, c in enumerate(cols[1:], start=2):
+                self.names.setdefault('{} ({})'.format(name, n), c)
+
+        self.keys = {}  # header_key => columns
+        for name, c in self.names.items():
+            self.keys.setdefault(header_key(name), set()).add(c)
+        self.resolved = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Joins the header rows of every column with a space (multi-line headers). Rows shorter than the
+        others (titles; Google Sheets leaves out trailing empty cells) are not part of the header.
+        :param rows: header rows
+        """
+        rows = list(rows)
+        width = max((len(row) for row in rows), default=0)
+        lines = [row for row in rows if len(row) == width]
+        columns = {}
+        for c in range(width):
+            words = [str(line[c]).strip() for line in lines if str(line[c]).strip()]
+            if words:
+                columns[c] = ' '.join(words)
+        return cls(columns)
+
+    def find(self, name):
+        """
+        Looks a name up as written, then loosely, but not by closest spelling.
+        :return: column index of header name, or None (not found, or loosely matching several columns)
+        """
+        col = self.names.get(name)
+        if col is None:
+            cols = self.keys.get(header_key(name), ())
+            # a loose name must point to a single column
+            if len(cols) == 1:
+                col = next(iter(cols))
+        return col
+
+    def resolve(self, name):
+        """
+        :return: column index of header name, or None (not found, or loosely matching several columns)
+        """
+        if name in self.resolved:
+            return self.resolved[name]
+        col = self.find(name)
+        key = header_key(name)
+        if col is None and key not in self.keys:
+            col = self.closest(key)
+        self.resolved[name] = col
+        return col
+
+    def closest(self, key):
+        """
+        Closest spelling of a loose name (see header_key) among the header names. Names with other
+        numbers are never close ({Nota 3} is not the Nota 2 column, {Nota} is neither Nota 1 nor Nota 2).
+        :return: column index, or None (nothing close, several names as close, or a name of several columns)
+        """
+        digits = digits_pattern.findall(key)
+        scores = {}
+        for k in self.keys:
+            if digits_pattern.findall(k) != digits:
+                continue
+            score = difflib.SequenceMatcher(None, key, k).ratio()
+            if score >= CLOSE_RATIO:
+                scores[k] = score
+        if not scores:
+            return None
+        best = max(scores.values())
+        close = [k for k, score in scores.items() if score == best]
+        if len(close) > 1 or len(self.keys[close[0]]) > 1:
+            return None
+        return next(iter(self.keys[close[0]]))
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __getitem__(self, name):
+        col = self.resolve(name)
+        if col is None:
+            raise KeyError(name)
+        return col
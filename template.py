@@ -0,0 +1,58 @@
+import html
+import re
+
+import markdown2
+
+SLOT = 'MAILSHEETSLOT{}X'
+slot_pattern = re.compile(r'MAILSHEETSLOT(\d+)X')
+placeholder_pattern = re.compile(r'\{([^{}]+)\}')
+
+
+class MailTemplate:
+    """
+    Mail text compiled once and rendered for every row.
+    Placeholders are {data} (always empty) and {<header name>} for any column found by
+    gsheet.get_header_columns. Names are resolved to columns here, once. Unknown placeholders are kept as they are.
+    """
+    def __init__(self, text, columns=None, markdown=True):
+        """
+        :param text: template text (Markdown if markdown is True)
+        :param columns: dict with header name (key) and column index (value), or sheet_table.HeaderIndex
+        :param markdown: convert text to HTML; row values are then HTML escaped
+        """
+        columns = columns or {}
+        self.escape = markdown
+        self.columns = []  # column index for every slot, None for {data}
+
+        def to_slot(m):
+            name = m.group(1).strip()
+            if name == 'data':
+                col = None
+            elif name in columns:
+                col = columns[name]
+            else:
+                return m.group(0)
+            self.columns.append(col)
+            return SLOT.format(len(self.columns) - 1)
+
+        # slots are plain words, so markdown leaves them alone
+        text = placeholder_pattern.sub(to_slot, text)
+        if markdown:
+            text = markdown2.markdown(text)
+
+        # literal, slot, literal, slot, ..., literal
+        self.parts = slot_pattern.split(text)
+        for i in range(1, len(self.parts), 2):
+            self.parts[i] = int(self.parts[i])
+
+    def render(self, row=()):
+        """
+        :param row: sheet row values
+        :return: text with every placeholder filled
+        """
+        out = list(self.parts)
+        for i in range(1, len(out), 2):
+            col = self.columns[out[i]]
+            value = str(row[col]) if col is not None and col < len(row) else ''
+            out[i] = html.escape(value) if self.escape else value
+        return ''.join(out)
@@ -0,0 +1,90 @@
+# Attachment building tests. Run with: python -m pytest
+from datetime import datetime, timezone
+from io import BytesIO
+
+import pytest
+from openpyxl import Workbook, load_workbook
+from openpyxl.comments import Comment
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.styles import Font, PatternFill
+from openpyxl.workbook.defined_name import DefinedName
+from openpyxl.worksheet.datavalidation import DataValidation
+
+from excel import keep_rows_generator, keep_rows_parallel, open_sheet_keep_row
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    """
+    Sheet with a styled header row, a styled column, formatted cells and a second sheet.
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'AV3'
+    ws.append(['Nome', 'Nota', 'E-mail', 'Data'])
+    ws.row_dimensions[1].font = Font(bold=True)
+    ws.row_dimensions[1].fill = PatternFill('solid', fgColor='FFFF00')
+    ws.column_dimensions['B'].font = Font(italic=True)
+    ws.column_dimensions['B'].fill = PatternFill('solid', fgColor='CCFFCC')
+    ws.append(['Ana', 9, 'ana@example.com', datetime(2020, 1, 1)])
+    ws.append(['Bia', 7, 'bia@example.com'])
+    ws['B3'].font = Font(color='FF0000')
+    ws['B2'].comment = Comment('note 1', 'Teacher')
+    ws['B3'].comment = Comment('note 2', 'Teacher')
+    ws['A2'].hyperlink = 'https://example.com/ana'
+    wb.create_sheet('Other').append(['not', 'used'])
+    path = tmp_path / 'source.xlsx'
+    wb.save(path)
+    return path
+
+
+def formats(ws):
+    """
+    Every format of a sheet, as compared between the attachment and the source workbook.
+    """
+    cells = {c.coordinate: (c.value, c.font.b, c.font.i, c.font.color and c.font.color.rgb, c.fill.fgColor.rgb, c.number_format,
+                            c.comment and c.comment.text, c.hyperlink and c.hyperlink.target)
+             for row in ws.iter_rows() for c in row}
+    columns = {k: (d.font.i, d.fill.fgColor.rgb) for k, d in ws.column_dimensions.items() if d.style_id}
+    rows = {k: (d.font.b, d.fill.fgColor.rgb) for k, d in ws.row_dimensions.items() if d.s}
+    return cells, columns, rows
+
+
+@pytest.mark.parametrize('row', [0, 1])
+def test_kept_row_loads_with_all_formats(workbook, tmp_path, row):
+    content, error = next(keep_rows_generator(str(workbook), 'AV3', 2, [(row, None)]))
+    assert error is None
+
+    expected = tmp_path / 'expected.xlsx'
+    open_sheet_keep_row(str(workbook), str(expected), 'AV3', 2, row)
+    kept = load_workbook(BytesIO(content))
+    assert kept.sheetnames == ['AV3']
+    assert formats(kept['AV3']) == formats(load_workbook(expected)['AV3'])
+
+
+def test_parallel_gives_same_files(workbook):
+    targets = [(0, None), (1, None), ([0, 1], None), (5, None)]
+    # files hold their modification time
+    modified = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    serial = list(keep_rows_generator(str(workbook), 'AV3', 2, targets, modified=modified))
+    parallel = list(keep_rows_parallel(str(workbook), 'AV3', 2, targets, workers=2, modified=modified))
+
+    assert [error is None for _, error in serial] == [True, True, True, False]
+    assert [content for content, _ in serial[:3]] == [content for content, _ in parallel[:3]]
+    assert parallel[3][0] is None and parallel[3][1] is not None
+
+
+def test_keeps_defined_names_used_by_the_sheet(workbook):
+    wb = load_workbook(workbook)
+    ws = wb['AV3']
+    for name, value in [('Statuses', '$C$10:$C$12'), ('Limit', '$D$10'), ('Unused', '$E$10')]:
+        wb.defined_names[name] = DefinedName(name, attr_text="'AV3'!{}".format(value))
+    validation = DataValidation(type='list', formula1='Statuses')
+    validation.add('E2:E3')
+    ws.add_data_validation(validation)
+    ws.conditional_formatting.add('B2:B3', FormulaRule(formula=['B2<Limit'], font=Font(bold=True)))
+    wb.save(workbook)
+
+    content, error = next(keep_rows_generator(str(workbook), 'AV3', 2, [(0, None)]))
+    assert error is None
+    assert sorted(load_workbook(BytesIO(content)).defined_names) == ['Limit', 'Statuses']
@@ -0,0 +1,395 @@
+# Sending tests against a local aiosmtpd server. Run with: python -m pytest
+import asyncio
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from journal import SendJournal
+from mail_async import AsyncEmailBackend
+import mail_send
+from mail_send import EmailMessage, PooledEmailBackend, as_bytes
+from metrics import metrics
+
+
+class Handler:
+    """
+    Accepts every mail, except recipients in refuse (550), and replies 451 to the mails of a
+    recipient in defer as many times as given. Recipients in greylist are refused with 450 as
+    many times as given.
+    """
+    def __init__(self):
+        self.received = []  # (client port, recipients)
+        self.sessions = []
+        self.refuse = set()
+        self.defer = {}  # recipient => temporary failures left
+        self.greylist = {}  # recipient => temporary refusals left
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refuse:
+            return '550 No such user'
+        if self.greylist.get(address, 0) > 0:
+            self.greylist[address] -= 1
+            return '450 Greylisted, try again later'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        if server not in self.sessions:
+            self.sessions.append(server)
+        for address in envelope.rcpt_tos:
+            if self.defer.get(address, 0) > 0:
+                self.defer[address] -= 1
+                return '451 Try again later'
+        self.received.append((session.peer[1], list(envelope.rcpt_tos)))
+        return '250 OK'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    handler = Handler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    try:
+        yield controller, handler
+    finally:
+        controller.stop()
+
+
+class PipeliningServer:
+    """
+    Minimal SMTP server advertising PIPELINING (aiosmtpd does not), refusing recipients in refuse (550).
+    Like some real servers, it replies 354 to DATA even when every recipient was refused.
+    The commands of every read are kept, to tell pipelined commands apart.
+    """
+    hostname = '127.0.0.1'
+
+    def __init__(self):
+        self.port = free_port()
+        self.refuse = set()
+        self.reads = []  # commands received by each read
+        self.received = []  # (client port, recipients)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._session, self.hostname, self.port), self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _session(self, reader, writer):
+        port = writer.get_extra_info('peername')[1]
+        writer.write(b'220 test ESMTP\r\n')
+        buffer = b''
+        recipients = []
+        in_data = False
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            *lines, buffer = (buffer + chunk).split(b'\r\n')
+            commands = []
+            for line in lines:
+                if in_data:
+                    if line == b'.':
+                        in_data = False
+                        if recipients:
+                            self.received.append((port, recipients))
+                            writer.write(b'250 OK\r\n')
+                        else:
+                            writer.write(b'554 No valid recipients\r\n')
+                        recipients = []
+                    continue
+                command = line.decode('utf-8')
+                verb = command.split(':')[0].split(' ')[0].upper()
+                commands.append(verb)
+                if verb == 'EHLO':
+                    writer.write(b'250-test\r\n250-PIPELINING\r\n250 8BITMIME\r\n')
+                elif verb in ('MAIL', 'RSET'):
+                    recipients = []
+                    writer.write(b'250 OK\r\n')
+                elif verb == 'RCPT':
+                    address = command[command.index('<') + 1:command.index('>')]
+                    if address in self.refuse:
+                        writer.write(b'550 No such user\r\n')
+                    else:
+                        recipients.append(address)
+                        writer.write(b'250 OK\r\n')
+                elif verb == 'DATA':
+                    in_data = True
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                elif verb == 'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                else:
+                    writer.write(b'500 Unknown command\r\n')
+            if commands:
+                self.reads.append(commands)
+            await writer.drain()
+            if 'QUIT' in commands:
+                break
+        writer.close()
+
+
+@pytest.fixture
+def pipelining_server():
+    server = PipeliningServer()
+    server.start()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+@pytest.fixture(params=[PooledEmailBackend, AsyncEmailBackend], ids=['threads', 'async'])
+def engine(request):
+    return request.param
+
+
+def make_backend(controller, engine, **options):
+    return engine(controller.hostname, controller.port, 'sender@example.com', None, **options)
+
+
+def make_mails(count, to='user{}@example.com'):
+    return [EmailMessage('Subject {}'.format(i), 'Body {}'.format(i), 'sender@example.com', [to.format(i)])
+            for i in range(count)]
+
+
+def test_pooled_send(smtp_server, engine):
+    controller, handler = smtp_server
+    backend = make_backend(controller, engine, connections=3)
+
+    assert backend.send_messages(iter(make_mails(10))) == 10
+    assert [r.index for r in backend.results] == list(range(10))
+    assert all(r.sent for r in backend.results)
+    assert sorted(rcpt[0] for _, rcpt in handler.received) == sorted('user{}@example.com'.format(i) for i in range(10))
+    assert len({port for port, _ in handler.received}) <= 3
+
+
+def committed_keys(path):
+    # read by another connection, as a later --resume run would
+    with sqlite3.connect(str(path)) as connection:
+        return {row[0] for row in connection.execute('SELECT key FROM sent')}
+
+
+def test_journal_is_committed_when_sending_ends(smtp_server, engine, tmp_path):
+    controller, handler = smtp_server
+    journal = SendJournal(str(tmp_path / 'journal.db'), batch_size=100, batch_interval=60)
+    mails = make_mails(3)
+    for i, mail in enumerate(mails):
+        mail.journal_key = 'key{}'.format(i)
+    try:
+        backend = make_backend(controller, engine, connections=2, journal=journal)
+        assert backend.send_messages(mails) == 3
+        assert committed_keys(tmp_path / 'journal.db') == {'key0', 'key1', 'key2'}
+    finally:
+        journal.close()
+
+
+def test_journal_commits_idle_batch(tmp_path):
+    journal = SendJournal(str(tmp_path / 'journal.db'), batch_size=100, batch_interval=0.05)
+    try:
+        journal.record('key0')
+        time.sleep(0.3)
+        assert committed_keys(tmp_path / 'journal.db') == {'key0'}
+    finally:
+        journal.close()
+
+
+def test_max_messages_per_connection(smtp_server, engine):
+    controller, handler = smtp_server
+    backend = make_backend(controller, engine, connections=1, max_messages_per_connection=2)
+
+    assert backend.send_messages(make_mails(5)) == 5
+    ports = [port for port, _ in handler.received]
+    assert len(set(ports)) == 3
+    assert all(ports.count(port) <= 2 for port in ports)
+
+
+def test_reconnect_after_disconnect(smtp_server, engine):
+    controller, handler = smtp_server
+    backend = make_backend(controller, engine, connections=1, keep_alive=True)
+    try:
+        assert backend.send_messages(make_mails(2)) == 2
+        assert len(backend.idle) == 1
+
+        # server drops the idle connection kept for the next call
+        for session in handler.sessions:
+            controller.loop.call_soon_threadsafe(session.transport.close)
+        time.sleep(0.2)
+
+        assert backend.send_messages(make_mails(2)) == 2
+        assert len({port for port, _ in handler.received}) == 2
+    finally:
+        backend.close()
+
+
+def test_results_per_message(smtp_server, engine):
+    controller, handler = smtp_server
+    handler.refuse.add('user1@example.com')
+    backend = make_backend(controller, engine, connections=2)
+
+    assert backend.send_messages(make_mails(3)) == 2
+    assert [r.sent for r in backend.results] == [True, False, True]
+    assert backend.results[1].to == ['user1@example.com']
+    assert backend.results[1].error is not None
+
+
+def test_temporary_error_is_retried(smtp_server, engine):
+    controller, handler = smtp_server
+    handler.defer['user0@example.com'] = 2
+    retries = metrics.counters.get('retries', 0)
+    backend = make_backend(controller, engine, connections=1, backoff=0.01)
+
+    assert backend.send_messages(make_mails(2)) == 2
+    assert all(r.sent for r in backend.results)
+    assert metrics.counters.get('retries', 0) - retries == 2
+    assert sorted(rcpt for _, rcpt in handler.received) == [['user0@example.com'], ['user1@example.com']]
+
+
+@pytest.mark.parametrize('failure', ['greylist', 'defer'])
+def test_temporary_error_reuses_connection(smtp_server, engine, failure):
+    controller, handler = smtp_server
+    getattr(handler, failure)['user0@example.com'] = 1
+    backend = make_backend(controller, engine, connections=1, backoff=0.01)
+    connects = metrics.timings.get('smtp_connect', [0])[0]
+
+    assert backend.send_messages(make_mails(2)) == 2
+    assert all(r.sent for r in backend.results)
+    assert metrics.timings['smtp_connect'][0] - connects == 1
+
+
+def test_temporary_error_gives_up_after_max_retries(smtp_server, engine):
+    controller, handler = smtp_server
+    handler.defer['user0@example.com'] = 10
+    backend = make_backend(controller, engine, connections=1, backoff=0.01, max_retries=2)
+
+    assert backend.send_messages(make_mails(1)) == 0
+    assert not backend.results[0].sent
+    assert backend.results[0].error.smtp_code == 451
+
+
+def test_failing_messages_stop_workers(smtp_server, engine):
+    controller, handler = smtp_server
+    backend = make_backend(controller, engine, connections=2)
+
+    def mails():
+        yield from make_mails(2)
+        raise ValueError('cannot prepare mail')
+
+    with pytest.raises(ValueError):
+        backend.send_messages(mails())
+    # mails already queued are still sent, then every connection is closed
+    assert len(handler.received) == 2
+    assert not [t for t in threading.enumerate() if t.name != 'MainThread' and t.daemon is False]
+
+
+def test_connection_refused_is_retried(engine):
+    # server only starts listening after the first attempts were refused
+    handler = Handler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    starting = threading.Timer(0.3, controller.start)
+    starting.start()
+    try:
+        backend = make_backend(controller, engine, connections=1, backoff=0.2)
+        assert backend.send_messages(make_mails(2)) == 2
+        assert len(handler.received) == 2
+    finally:
+        starting.join()
+        controller.stop()
+
+
+def test_connection_refused_gives_up_after_max_retries(engine):
+    retries = metrics.counters.get('retries', 0)
+    backend = engine('127.0.0.1', free_port(), 'sender@example.com', None, connections=1, backoff=0.01, max_retries=2)
+
+    assert backend.send_messages(make_mails(3)) == 0
+    assert [r.sent for r in backend.results] == [False, False, False]
+    assert isinstance(backend.results[0].error, ConnectionRefusedError)
+    assert metrics.counters.get('retries', 0) - retries == 2
+
+
+def test_pipelined_send_with_refused_recipient(pipelining_server):
+    pipelining_server.refuse.add('b@example.com')
+    mails = [EmailMessage('Subject', 'Body', 'sender@example.com', ['a@example.com', 'b@example.com']),
+             EmailMessage('Subject', 'Body', 'sender@example.com', ['c@example.com'])]
+    backend = make_backend(pipelining_server, AsyncEmailBackend, connections=1)
+
+    assert backend.send_messages(mails) == 2
+    assert [rcpt for _, rcpt in pipelining_server.received] == [['a@example.com'], ['c@example.com']]
+    # MAIL, RCPT and DATA written together
+    assert ['MAIL', 'RCPT', 'RCPT', 'DATA'] in pipelining_server.reads
+
+
+def test_pipelined_send_recovers_when_every_recipient_is_refused(pipelining_server):
+    pipelining_server.refuse.add('user1@example.com')
+    backend = make_backend(pipelining_server, AsyncEmailBackend, connections=1)
+
+    assert backend.send_messages(make_mails(3)) == 2
+    assert [r.sent for r in backend.results] == [True, False, True]
+    assert isinstance(backend.results[1].error, smtplib.SMTPRecipientsRefused)
+    # the pipelined DATA (accepted with 354) is ended and reset, the next mail uses the same connection
+    assert ['RSET'] in pipelining_server.reads
+    assert [rcpt for _, rcpt in pipelining_server.received] == [['user0@example.com'], ['user2@example.com']]
+    assert len({port for port, _ in pipelining_server.received}) == 1
+
+
+def test_no_mails_are_prepared_once_every_connection_failed(engine):
+    prepared = []
+
+    def mails():
+        for mail in make_mails(50):
+            prepared.append(mail)
+            yield mail
+
+    backend = engine('127.0.0.1', free_port(), 'sender@example.com', None, connections=1, max_retries=0)
+    assert backend.send_messages(mails()) == 0
+    assert len(prepared) < 10
+    assert [r.index for r in backend.results] == list(range(len(prepared)))
+    assert not any(r.sent for r in backend.results)
+
+
+@pytest.fixture
+def fixed_boundary(monkeypatch):
+    # boundaries are random, the same one is used so both ways of building a message can be compared
+    monkeypatch.setattr(mail_send.generator, '_make_boundary', lambda text=None: '==boundary==')
+    monkeypatch.setattr(mail_send.generator.Generator, '_make_boundary', classmethod(lambda cls, text=None: '==boundary=='))
+
+
+@pytest.mark.parametrize('filename', ['notas.xlsx', 'relatório.xlsx'])
+def test_message_chunks_are_the_flattened_message(fixed_boundary, filename):
+    headers = {'Date': 'Thu, 01 Oct 2020 10:00:00 -0000', 'Message-ID': '<1@example.com>'}
+    content = bytes(range(256)) * 40
+    mail = EmailMessage('Notas', 'Olá,\n.linha com ponto\n', 'sender@example.com', ['ana@example.com'],
+                        attachments=[(filename, content, 'application/octet-stream')], headers=headers)
+
+    assert b''.join(mail.message_chunks()) == as_bytes(mail.message(), linesep='\r\n')
+
+
+def test_shared_attachment_is_encoded_once(monkeypatch):
+    created = []
+    create = EmailMessage._create_mime_attachment
+    monkeypatch.setattr(EmailMessage, '_create_mime_attachment',
+                        lambda self, content, mimetype: created.append(mimetype) or create(self, content, mimetype))
+    content = b'shared attachment ' + str(time.time()).encode('ascii')
+    mails = [EmailMessage('Notas', 'Body', 'sender@example.com', [to], attachments=[(name, content, 'application/pdf')])
+             for to, name in [('ana@example.com', 'ana.pdf'), ('bia@example.com', 'bia.pdf')]]
+
+    chunks = [b''.join(mail.message_chunks()) for mail in mails]
+    assert created == ['application/pdf']
+    assert b'filename="ana.pdf"' in chunks[0] and b'filename="bia.pdf"' in chunks[1]
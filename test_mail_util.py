@@ -0,0 +1,72 @@
+# Mail preparation tests (grouping by recipient and cc digest). Run with: python -m pytest
+import pytest
+
+from journal import journal_key
+from mail_util import group_rows, iter_mails
+
+CREDENTIALS = {'username': 'teacher@example.com'}
+HEADERS = {0: 'Nome', 1: 'E-mail', 2: 'Nota'}
+
+
+@pytest.fixture
+def data():
+    return [('Ana', 'ana@example.com', 9),
+            ('Bia', 'bia@example.com', 7),
+            ('Ana', ' ANA@Example.com ', 8),
+            ('Bia', 'bia@example.com', 7),
+            ('Caio', 'caio@example.com', 6)]
+
+
+def make_config(group=False, digest=False, cc=''):
+    return {'sheet': {'url': 'grades.xlsx', 'name': 'AV1', 'email-col': 2},
+            'email': {'subject': 'Nota de {Nome}', 'msg': '{Nome}: {Nota}', 'cc': cc,
+                      'group-by-recipient': group, 'cc-digest': digest, 'attachment-format': 'csv'}}
+
+
+def test_rows_are_not_grouped_by_default(data):
+    assert group_rows(data, make_config()) == [[0], [1], [2], [3], [4]]
+    assert group_rows(data, make_config(), rows=[1, 3]) == [[1], [3]]
+
+
+def test_rows_are_grouped_by_recipient(data):
+    # addresses are compared ignoring case and spaces, identical rows are sent once
+    assert group_rows(data, make_config(group=True)) == [[0, 2], [1], [4]]
+    assert group_rows(data, make_config(group=True), rows=[2, 3, 4]) == [[2], [3], [4]]
+
+
+def test_grouped_mail_has_every_row(data):
+    config = make_config(group=True)
+    mails = list(iter_mails(data, config, CREDENTIALS, headers=HEADERS))
+
+    assert [m.to for m in mails] == [['ana@example.com'], ['bia@example.com'], ['caio@example.com']]
+    assert [m.rows for m in mails] == [[0, 2], [1], [4]]
+    assert mails[0].body == '<p>Ana: 9</p>\n\n<hr>\n<p>Ana: 8</p>\n'
+    name, content, mimetype = mails[0].attachments[0]
+    assert content.splitlines()[1:] == ['Ana,ana@example.com,9', 'Ana, ANA@Example.com ,8']
+
+    texts = [config['email']['subject'], config['email']['msg']]
+    assert mails[0].journal_key == journal_key('grades.xlsx!AV1', 0, 'ana@example.com', [[data[0], data[2]]] + texts)
+    assert mails[1].journal_key == journal_key('grades.xlsx!AV1', 1, 'bia@example.com', [data[1]] + texts)
+    # a mail of a single row has the same key as without grouping
+    assert mails[1].journal_key == list(iter_mails(data, make_config(), CREDENTIALS, headers=HEADERS))[1].journal_key
+
+
+def test_cc_digest_is_one_mail_with_every_row(data):
+    config = make_config(group=True, digest=True, cc='coord@example.com; head@example.com')
+    mails = list(iter_mails(data, config, CREDENTIALS, headers=HEADERS))
+
+    digest = mails[-1]
+    assert len(mails) == 4
+    assert digest.to == ['coord@example.com', 'head@example.com']
+    assert digest.subject == 'Summary: 3 mails'
+    name, content, mimetype = digest.attachments[0]
+    assert (name, mimetype) == ('digest.csv', 'text/csv')
+    assert content.splitlines()[0] == '\ufeffNome,E-mail,Nota'
+    assert len(content.splitlines()) == 5
+    assert digest.journal_key == journal_key('grades.xlsx!AV1', 'digest', 'coord@example.com;head@example.com',
+                                             [m.journal_key for m in mails[:-1]])
+
+
+def test_no_digest_without_cc(data):
+    mails = list(iter_mails(data, make_config(digest=True), CREDENTIALS, headers=HEADERS))
+    assert len(mails) == 5
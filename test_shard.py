@@ -0,0 +1,84 @@
+# Sharded sending coordination tests. Run with: python -m pytest
+import pytest
+
+from mail_send import EmailMessage, SendResult
+from shard import Shard, ShardStore, shard_of
+
+
+@pytest.fixture
+def stores(tmp_path):
+    # two stores on the same file, as two shard processes (or hosts) use it
+    path = str(tmp_path / 'shards.db')
+    first, second = ShardStore(path), ShardStore(path)
+    try:
+        yield first, second
+    finally:
+        first.close()
+        second.close()
+
+
+def make_mails(count):
+    mails = [EmailMessage('Subject', 'Body', 'sender@example.com', ['user{}@example.com'.format(i)]) for i in range(count)]
+    for i, mail in enumerate(mails):
+        mail.journal_key = 'key{}'.format(i)
+    return mails
+
+
+def test_claim_is_exclusive_across_stores(stores):
+    first, second = stores
+    assert first.claim('key', 0, 'a@example.com') is True
+    assert second.claim('key', 1, 'b@example.com') is False
+    # the same shard may claim again (a repeated run)
+    assert second.claim('key', 0, 'a@example.com') is True
+
+    first.mark_sent('key')
+    assert second.is_sent('key')
+    assert first.claim('key', 0, 'a@example.com') is False
+    # sent mails are never released
+    second.release('key')
+    assert first.is_sent('key')
+
+
+def test_stale_claim_is_taken_over(tmp_path):
+    store = ShardStore(str(tmp_path / 'shards.db'), stale_after=0)
+    try:
+        assert store.claim('key', 0, 'a@example.com') is True
+        assert store.claim('key', 1, 'b@example.com') is True
+    finally:
+        store.close()
+
+
+def test_daily_quota_is_shared_by_profile(stores):
+    first, second = stores
+    assert first.claim('key0', 0, 'a@example.com', per_day=2) is True
+    assert second.claim('key1', 1, 'a@example.com', per_day=2) is True
+    assert first.claim('key2', 0, 'a@example.com', per_day=2) is None
+    assert second.claim('key2', 1, 'b@example.com', per_day=2) is True
+
+
+def test_claim_mails_stops_at_quota(stores):
+    first, second = stores
+    second.claim('key1', 1, 'b@example.com')
+    shard = Shard(first, 0, 2, 'a@example.com', per_day=2)
+
+    # key1 is being sent by the other shard, key3 is over the quota
+    assert [m.journal_key for m in shard.claim_mails(make_mails(4))] == ['key0', 'key2']
+    assert shard.claimed == ['key0', 'key2']
+
+
+def test_failed_mails_are_released(stores):
+    first, second = stores
+    shard = Shard(first, 0, 2, 'a@example.com')
+    mails = list(shard.claim_mails(make_mails(3)))
+    for mail in (mails[0], mails[2]):
+        shard.record(mail.journal_key)
+    shard.release_failed([SendResult(0, mails[0].to, True, None), SendResult(1, mails[1].to, False, None),
+                          SendResult(2, mails[2].to, True, None)])
+
+    assert [second.claim(key, 1, 'b@example.com') for key in ('key0', 'key1', 'key2')] == [False, True, False]
+    assert 'key0' in shard and 'key1' not in shard
+
+
+def test_shard_of_is_stable():
+    assert shard_of(' Ana@Example.com', 4) == shard_of('ana@example.com', 4)
+    assert {shard_of('user{}@example.com'.format(i), 4) for i in range(100)} == {0, 1, 2, 3}
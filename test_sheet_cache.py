@@ -0,0 +1,90 @@
+# Google Sheets cache and --changed-only tests, with a fake client. Run with: python -m pytest
+import pytest
+
+from gsheet import SheetsClient
+from sheet_cache import SheetCache
+
+URL = 'https://docs.google.com/spreadsheets/d/sheet-id/edit'
+
+
+class FakeClient(SheetsClient):
+    """
+    SheetsClient answering from memory instead of Google, counting requests.
+    """
+    def __init__(self, values):
+        super().__init__(None)
+        self.values = values  # range => values
+        self.file_version = '1'
+        self.requests = []
+
+    def version(self, sheet_id):
+        self.requests.append('version')
+        return self.file_version
+
+    def batch_get(self, sheet_id, ranges):
+        self.requests.append(('batch_get', tuple(ranges)))
+        return [self.values[r] for r in ranges]
+
+    def export(self, sheet_url):
+        self.requests.append('export')
+        return b'xlsx ' + self.file_version.encode('ascii')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SheetCache(str(tmp_path / 'cache.db'))
+    try:
+        yield cache
+    finally:
+        cache.close()
+
+
+@pytest.fixture
+def client():
+    return FakeClient({'AV1!A1:C3': [['Nome', 'E-mail'], ['Ana', 'ana@example.com']], 'AV2!A1:C3': [['Nome']]})
+
+
+def test_unchanged_version_uses_cached_values(cache, client, tmp_path):
+    ranges = ['AV1!A1:C3', 'AV2!A1:C3']
+    export = tmp_path / 'export.xlsx'
+    first = client.read_ranges(URL, ranges, str(export), cache)
+    assert client.requests == ['version', ('batch_get', tuple(ranges)), 'export']
+
+    client.requests = []
+    export.unlink()
+    assert client.read_ranges(URL, ranges, str(export), cache) == first
+    # only the Drive version is asked, values and export come from the cache
+    assert client.requests == ['version']
+    assert export.read_bytes() == b'xlsx 1'
+
+
+def test_new_version_fetches_again(cache, client, tmp_path):
+    client.read_ranges(URL, ['AV1!A1:C3'], None, cache)
+    client.values['AV1!A1:C3'] = [['Nome', 'E-mail'], ['Bia', 'bia@example.com']]
+    client.file_version = '2'
+    client.requests = []
+
+    assert client.read_ranges(URL, ['AV1!A1:C3'], None, cache) == [client.values['AV1!A1:C3']]
+    assert client.requests == ['version', ('batch_get', ('AV1!A1:C3',))]
+    # a range never fetched is fetched alone
+    client.requests = []
+    client.read_ranges(URL, ['AV1!A1:C3', 'AV2!A1:C3'], None, cache)
+    assert client.requests == ['version', ('batch_get', ('AV2!A1:C3',))]
+
+
+def test_changed_rows(cache):
+    rows = [['Ana', 'ana@example.com', 9], ['Bia', 'bia@example.com', 7], ['Caio', 'caio@example.com', 6]]
+    # no previous run: every row
+    assert cache.changed_rows(URL, 'A1:C4', rows) == [0, 1, 2]
+
+    # Caio's mail failed
+    cache.mark_rows_seen(URL, 'A1:C4', rows, [0, 1])
+    assert cache.changed_rows(URL, 'A1:C4', rows) == [2]
+    assert cache.changed_rows(URL, 'A1:C9', rows) == [0, 1, 2]
+
+    rows[1] = ['Bia', 'bia@example.com', 8]
+    assert cache.changed_rows(URL, 'A1:C4', rows) == [1, 2]
+
+    # rows not delivered by this run keep their state: Ana stays seen, Bia's new grade is sent later
+    cache.mark_rows_seen(URL, 'A1:C4', rows, [2])
+    assert cache.changed_rows(URL, 'A1:C4', rows) == [1]
@@ -0,0 +1,129 @@
+# Sheet table and header name resolution tests. Run with: python -m pytest
+from datetime import datetime
+
+import pytest
+
+from sheet_table import Column, HeaderIndex, SheetTable
+from validation import validate_rows
+
+
+@pytest.fixture
+def rows():
+    return [('Nome', 'Nota', 'Peso', 'Data', 'Aprovado'),
+            ('Ana', 9, 1.5, datetime(2020, 1, 2, 10, 30), True),
+            ('Bia', None, 2.0, datetime(2020, 1, 3), False),
+            ('Caio', 7, 0.5, datetime(2020, 1, 4), None),
+            ('Davi', 8)]
+
+
+def test_table_gives_back_the_rows(rows):
+    table = SheetTable.from_rows(rows)
+
+    assert [c.kind for c in table.columns] == ['text', 'int', 'float', 'datetime', 'text']
+    # empty cells are '', dates are shown without time, short rows keep their length
+    assert list(table) == [('Nome', 'Nota', 'Peso', 'Data', 'Aprovado'),
+                           ('Ana', 9, 1.5, '02/01/2020', True),
+                           ('Bia', '', 2.0, '03/01/2020', False),
+                           ('Caio', 7, 0.5, '04/01/2020', ''),
+                           ('Davi', 8)]
+    assert all(isinstance(row, tuple) for row in table)
+    assert table[-1] == ('Davi', 8)
+    with pytest.raises(IndexError):
+        table[5]
+
+
+@pytest.mark.parametrize('values, kind, other', [
+    ([1, 2, 3], 'int', {}),
+    (['Nota', 1, 2], 'int', {0: 'Nota'}),
+    ([1.5, 2, 3.5], 'float', {1: 2}),
+    ([True, False, 1], 'text', {}),
+    ([None, None], 'text', {}),
+    ([2 ** 70, 1, 2], 'text', {}),
+])
+def test_column_types(values, kind, other):
+    column = Column(values)
+    assert column.kind == kind
+    assert column.other == other
+    assert [column[i] for i in range(len(values))] == ['' if v is None else v for v in values]
+
+
+def test_date_column_keeps_other_cells_aside():
+    column = Column(['Data', datetime(2020, 1, 2, 10, 30), 'sem data', datetime(2021, 12, 31), datetime(2022, 1, 1)])
+    assert column.kind == 'datetime'
+    assert column.other == {0: 'Data', 2: 'sem data'}
+    assert [column[i] for i in range(5)] == ['Data', '02/01/2020', 'sem data', '31/12/2021', '01/01/2022']
+
+
+def test_slices_share_columns(rows):
+    table = SheetTable.from_rows(rows)
+    body = table[1:]
+    assert body.columns is table.columns
+    assert len(body) == 4
+    assert body[0] == table[1]
+    assert list(body[1:3]) == [table[2], table[3]]
+    assert body[1:3][1] == table[3]
+
+
+@pytest.fixture
+def grades():
+    return HeaderIndex({0: 'Nome', 1: 'E-mail', 2: 'Nota 1', 3: 'Nota 2', 4: 'Situação'})
+
+
+def config(msg):
+    return {'sheet': {'email-col': 2, 'range': 'A1:E10', 'header-rows': 1},
+            'email': {'subject': 'Notas', 'msg': msg}}
+
+
+@pytest.mark.parametrize('name, col', [
+    ('Nome', 0),
+    ('e-mail', 1),
+    ('EMAIL', 1),
+    ('nota 2', 3),
+    ('Situacao', 4),
+    ('Situaçao ', 4),
+    ('Sitaução', 4),
+])
+def test_resolves_written_loose_and_close_names(grades, name, col):
+    assert grades.resolve(name) == col
+    assert grades[name] == col
+
+
+@pytest.mark.parametrize('name', ['Nota', 'Nota 3', 'Nota 12', 'Notas 1 e 2', 'Endereço'])
+def test_never_resolves_names_with_other_numbers(grades, name):
+    assert grades.resolve(name) is None
+    assert name not in grades
+    with pytest.raises(KeyError):
+        grades[name]
+
+
+def test_rejects_equally_close_names():
+    header = HeaderIndex({0: 'Prova A', 1: 'Prova B'})
+    assert header.resolve('Prova C') is None
+    assert header.resolve('prova-a') == 0
+
+
+def test_find_ignores_close_spelling(grades):
+    assert grades.find('E MAIL') == 1
+    assert grades.find('Sitaução') is None
+
+
+def test_repeated_names():
+    header = HeaderIndex({0: 'Nota', 1: 'E-mail', 2: 'Nota', 3: 'Nota'})
+    assert header.duplicates == {'Nota': [0, 2, 3]}
+    assert [header['Nota'], header['Nota (2)'], header['Nota (3)']] == [0, 2, 3]
+
+
+def test_from_rows_joins_multi_line_headers():
+    header = HeaderIndex.from_rows([['Turma A'], ['Nome', 'Nota', ''], ['', 'AV1', 'E-mail']])
+    assert header.columns == {0: 'Nome', 1: 'Nota AV1', 2: 'E-mail'}
+
+
+def test_close_placeholder_is_an_error_when_strict(grades):
+    data = [('Ana', 'ana@example.com', 9, 7, 'Aprovada')]
+    _, errors, warnings = validate_rows(data, config('{Sitaução} {Nota 3}'), grades)
+    assert errors == []
+    assert 'Unknown placeholder {Nota 3} in msg is sent as is' in warnings
+    assert 'Placeholder {Sitaução} in msg is filled with column Situação' in warnings
+
+    _, errors, _ = validate_rows(data, config('{Sitaução} {nota 1}'), grades, strict=True)
+    assert errors == ['Placeholder {Sitaução} in msg only matches column Situação by closest spelling']
@@ -0,0 +1,49 @@
+# Mail template tests. Run with: python -m pytest
+import markdown2
+import pytest
+
+from mail_util import symbols_replace
+from sheet_table import HeaderIndex
+from template import MailTemplate
+
+COLUMNS = {'Nome': 0, 'Nota': 1, 'E-mail': 2}
+
+
+def test_fills_placeholders():
+    template = MailTemplate('{Nome}: nota {Nota}{data} ({ Nome })', COLUMNS, markdown=False)
+    assert template.render(('Ana', 9, 'ana@example.com')) == 'Ana: nota 9 (Ana)'
+    assert template.render(('Bia', 7.5, 'bia@example.com')) == 'Bia: nota 7.5 (Bia)'
+
+
+def test_keeps_unknown_placeholders_and_fills_missing_cells():
+    template = MailTemplate('{Nome} {Outro} {Nota}', COLUMNS, markdown=False)
+    # Google Sheets leaves out empty cells at the end of a row
+    assert template.render(('Ana',)) == 'Ana {Outro} '
+
+
+def test_resolves_names_with_header_index():
+    template = MailTemplate('{e-mail}', HeaderIndex({0: 'Nome', 1: 'E-mail'}), markdown=False)
+    assert template.render(('Ana', 'ana@example.com')) == 'ana@example.com'
+
+
+def test_escapes_row_values_in_html():
+    template = MailTemplate('Hello **{Nome}**', COLUMNS)
+    assert template.render(('<b>Ana & Bia</b>',)) == '<p>Hello <strong>&lt;b&gt;Ana &amp; Bia&lt;/b&gt;</strong></p>\n'
+    assert MailTemplate('{Nome}', COLUMNS, markdown=False).render(('<b>',)) == '<b>'
+
+
+@pytest.mark.parametrize('msg', [
+    'Hello,\n\nyour grade is in the attachment.{data}\n\natt,\n\nTeacher',
+    '# Results\n\n* **AV1**: see _attachment_\n* [course page](https://example.com/a_b)\n\n{data}',
+    'Line with {unknown} and 1 < 2 & 3 > 2',
+])
+def test_same_html_as_replacing_after_markdown(msg):
+    # the message built before templates were compiled (prepare_mail)
+    expected = symbols_replace(markdown2.markdown(msg), {'{data}': ''})
+    assert MailTemplate(msg, COLUMNS).render(('Ana', 9)) == expected
+
+
+def test_same_html_as_markdown_of_filled_text():
+    msg = 'Hello **{Nome}**,\n\n* grade: {Nota}\n\natt,\n\nTeacher'
+    row = ('Ana Maria', 9.5)
+    assert MailTemplate(msg, COLUMNS).render(row) == markdown2.markdown(msg.format(Nome=row[0], Nota=row[1]))
@@ -0,0 +1,105 @@
+import re
+
+from mail_util import ATTACHMENT_FORMATS
+from sheet_table import HeaderIndex
+from template import placeholder_pattern
+
+# one address: no spaces or separators, a single @ and a dot in the domain
+address_pattern = re.compile(r'[^@\s;,<>"]+@[^@\s;,<>"]+\.[^@\s;,<>".]+')
+range_start_pattern = re.compile(r'[A-Za-z]+(\d+)')
+
+
+class ValidationError(Exception):
+    pass
+
+
+def resolve_email_column(config, header):
+    """
+    Sets email-col from email-column (a header name) in the sheet section of config, when given.
+    The name must match a header as written or loosely (see HeaderIndex.find): a close spelling
+    is not enough for the column deciding where mail goes.
+    :param header: HeaderIndex of the sheet, None if it has no header rows
+    :raises ValidationError: no single column has that name
+    """
+    name = config["sheet"].get("email-column")
+    if not name:
+        return
+    col = header.find(name) if header is not None else None
+    if col is None:
+        names = ', '.join(header.columns.values()) if header is not None else 'no header rows'
+        raise ValidationError('email-column {} is not a column of the sheet ({})'.format(name, names))
+    config["sheet"]["email-col"] = col + 1
+
+
+def validate_settings(config):
+    """
+    Checks settings that would otherwise only fail once mails are being built (and some already sent).
+    :raises ValidationError: invalid setting
+    """
+    attachment_format = config["email"].get("attachment-format", "xlsx")
+    if attachment_format not in ATTACHMENT_FORMATS:
+        raise ValidationError('Invalid attachment-format {}. Use one of: {}'.format(attachment_format, ', '.join(ATTACHMENT_FORMATS)))
+
+
+def validate_rows(data, config, headers=None, strict=False):
+    """
+    Checks every row before any attachment is built or mail sent, so all problems are reported at once.
+    Rows are rejected for an empty, missing or malformed email cell (cells may hold several
+    addresses separated by ;). Config problems (email-col outside range, unknown placeholders)
+    and repeated recipients are reported too.
+    :param data: sheet values without header rows (same as given to iter_mails)
+    :param headers: header columns (see gsheet.get_header_columns) or HeaderIndex
+    :param strict: a placeholder only matching a header by closest spelling is an error, not a warning
+    :return: indexes of valid rows, list of errors, list of warnings
+    """
+    errors = []
+    warnings = []
+    email_col = config["sheet"]["email-col"] - 1
+    width = max((len(row) for row in data), default=0)
+    if email_col < 0 or (data and email_col >= width):
+        errors.append('email-col {} is outside the sheet range ({} columns)'.format(email_col + 1, width))
+        return [], errors, warnings
+
+    if headers:
+        header = headers if isinstance(headers, HeaderIndex) else HeaderIndex(headers)
+        for name, cols in header.duplicates.items():
+            warnings.append('Header {} is repeated, {{{}}} is column {} (others: {})'.format(
+                name, name, cols[0] + 1, ', '.join('{{{} ({})}}'.format(name, n) for n in range(2, len(cols) + 1))))
+        for field in ('subject', 'msg'):
+            for name in placeholder_pattern.findall(config["email"][field]):
+                name = name.strip()
+                col = header.resolve(name)
+                if name == 'data' or name in header.names:
+                    continue
+                if col is None:
+                    warnings.append('Unknown placeholder {{{}}} in {} is sent as is'.format(name, field))
+                elif header.find(name) is None and strict:
+                    errors.append('Placeholder {{{}}} in {} only matches column {} by closest spelling'.format(name, field, header.columns[col]))
+                else:
+                    warnings.append('Placeholder {{{}}} in {} is filled with column {}'.format(name, field, header.columns[col]))
+
+    # sheet row number of data[0], as shown by the spreadsheet
+    m = range_start_pattern.match(config["sheet"]["range"])
+    first_row = (int(m.group(1)) if m else 1) + config["sheet"]["header-rows"]
+
+    # Google Sheets leaves out empty cells at the end of a row
+    cells = [str(row[email_col]).strip() if email_col < len(row) else '' for row in data]
+    valid = []
+    seen = {}  # recipient => sheet row numbers
+    for l, cell in enumerate(cells):
+        addresses = [a.strip() for a in cell.split(';') if a.strip()]
+        if not addresses:
+            errors.append('Row {}: empty email'.format(first_row + l))
+            continue
+        invalid = [a for a in addresses if not address_pattern.fullmatch(a)]
+        if invalid:
+            errors.append('Row {}: invalid email {}'.format(first_row + l, ', '.join(invalid)))
+            continue
+        valid.append(l)
+        seen.setdefault(cell.lower(), []).append(first_row + l)
+
+    if not config["email"].get("group-by-recipient", False):
+        for recipient, rows in seen.items():
+            if len(rows) > 1:
+                warnings.append('{} gets {} mails (rows {})'.format(recipient, len(rows), ', '.join(map(str, rows))))
+    return valid, errors, warnings